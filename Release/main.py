@@ -1,5 +1,6 @@
 import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, scrolledtext
+from tkinter import ttk, filedialog, messagebox, scrolledtext, simpledialog
+import tkinter.font as tkfont
 import subprocess
 import os
 import platform
@@ -9,6 +10,23 @@ import time
 import queue
 import uuid
 import threading
+import asyncio
+import gzip
+import shutil
+import re
+import glob
+import bisect
+import collections
+import itertools
+import csv
+import heapq
+import calendar
+import concurrent.futures
+import multiprocessing
+import mmap
+import sqlite3
+import contextlib
+from multiprocessing import shared_memory
 
 class MainApplication(tk.Tk):
     def __init__(self):
@@ -895,7 +913,2773 @@ class FastbootTools(ttk.Frame):
         self.output_text.see(tk.END)
         self.update_idletasks()
 
+class CaptureLoop:
+    """所有抓取管道共用的单线程异步读取循环"""
+    def __init__(self):
+        # Windows下默认为Proactor事件循环，支持子进程管道的非阻塞读取
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name="CaptureLoop", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        """从任意线程提交协程到读取循环"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, func, *args):
+        """从任意线程把函数调度到读取循环线程执行"""
+        self.loop.call_soon_threadsafe(func, *args)
+
+class WriterThread:
+    """所有LogWriter共用的写盘线程：各写入器的数据按提交顺序进入同一个队列
+
+    线程数与抓取窗口数无关；每个写入器自己的刷新和轮转在处理完队列项后按时间检查。
+    """
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, tick=0.2):
+        self.tick_interval = tick
+        self.q = queue.Queue()
+        self.writers = set()  # 已打开、需要定时刷新的写入器，只在写盘线程中访问
+        self.thread = threading.Thread(target=self.run, name="LogWriter", daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def put(self, writer, item):
+        self.q.put((writer, item))
+
+    def run(self):
+        while True:
+            try:
+                writer, item = self.q.get(timeout=self.tick_interval)
+            except queue.Empty:
+                writer = None
+            if writer is not None and not writer.failed:
+                try:
+                    if item is LogWriter.OPEN:
+                        writer.start()
+                        self.writers.add(writer)
+                    elif item is None:
+                        self.writers.discard(writer)
+                        writer.finish()
+                    else:
+                        writer.handle(*item)
+                except Exception as e:
+                    self.writers.discard(writer)
+                    writer.fail(e)
+            # 即使没有新数据也按时间刷新，保证外部查看文件时内容及时
+            now = time.time()
+            for writer in list(self.writers):
+                try:
+                    writer.tick(now)
+                except Exception as e:
+                    self.writers.discard(writer)
+                    writer.fail(e)
+
+class LogWriter:
+    """写盘：大缓冲写入、定时刷新、按大小/时间轮转并压缩旧分段；实际写入在共用的WriterThread中进行
+
+    每个分段旁边维护一个稀疏索引文件（分段名 + .idx），每行记录
+    "行号\t字节偏移\t时间戳"，供SegmentIndex按时间或行号直接定位。
+    写盘出错（磁盘满等）时停止接收新数据，并通过on_error通知抓取会话；
+    轮转时分段被其他程序占用而改名失败则继续写当前分段，稍后再试。
+    """
+    OPEN = object()  # 写盘线程中的初始化，之后开始定时刷新和轮转检查
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, max_age=3600, compress=True,
+                 flush_interval=1.0, buffer_size=1024 * 1024, index_every=1000, fts=False, rotate_retry=30):
+        self.path = path
+        self.fts = fts  # 为True时同时交给FtsWriter在独立线程中建立全文索引
+        self.fts_writer = None
+        self.line_base = 0  # 当前分段第一行在整个会话中的行号
+        self.index_every = index_every
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.rotate_retry = rotate_retry  # 轮转失败后隔多少秒重试
+        self.rotate_after = 0.0
+        self.rotate_error = None  # 最近一次轮转失败的原因，成功后清除
+        self.submitted = 0  # 已提交的批数，只由提交方增加
+        self.written = 0    # 已写入的批数，只由写盘线程增加
+        self.latency = 0.0  # 最近一批从到达到写入的耗时
+        self.failed = False
+        self.on_error = None  # 写盘出错时的回调，参数为提示文字
+        self.done = threading.Event()
+        self.open_segment()  # 在调用线程中打开，路径错误可直接提示
+        # 同一路径上次抓取留下的已轮转分段也算在会话行号内，与SegmentIndex一致
+        segments = SegmentIndex(self.path).segments
+        self.line_base = segments[-1]['first_line'] if segments else 0
+        self.thread = WriterThread.shared()
+        self.thread.put(self, self.OPEN)
+
+    def open_segment(self):
+        self.file = open(self.path, 'ab', buffering=self.buffer_size)
+        self.size = self.file.tell()
+        self.opened_at = time.time()
+        self.lines = 0
+        if self.size:
+            entries = SegmentIndex.read_entries(self.path + '.idx')
+            if not entries or entries[-1][1] > self.size:
+                # 没有可用索引的旧文件（如早期版本留下的大文件）：数行要读完整个文件，
+                # 改为把它按分段命名移到一旁，本次从新文件开始
+                self.file.close()
+                self.set_aside()
+                self.file = open(self.path, 'ab', buffering=self.buffer_size)
+                self.size = 0
+            else:
+                self.lines = self.count_existing_lines(entries)
+        self.index_file = open(self.path + '.idx', 'a', encoding='utf-8')
+        self.indexed_line = None
+        self.indexed_sec = None
+        self.last_ts = self.opened_at
+        self.last_flush = self.opened_at
+
+    def set_aside(self):
+        segment = self.segment_name(os.path.getmtime(self.path))
+        os.replace(self.path, segment)
+        if os.path.exists(self.path + '.idx'):
+            os.remove(self.path + '.idx')  # 索引与文件内容不符
+
+    def count_existing_lines(self, entries):
+        """追加到已有文件时，从其索引的最后一项开始数出已有行数（只需读最后一项之后的少量数据）"""
+        line_no, offset = entries[-1][0], entries[-1][1]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                line_no += block.count(b'\n')
+        return line_no
+
+    def add_index(self, ts):
+        self.index_file.write(f"{self.lines}\t{self.size}\t{ts:.3f}\n")
+        self.indexed_line = self.lines
+        self.indexed_sec = int(ts)
+
+    def write(self, lines, ts=None):
+        """提交一批行，由写盘线程异步写入；ts为这批行的到达时间"""
+        if lines and not self.failed:
+            self.submitted += 1
+            self.thread.put(self, (ts or time.time(), lines))
+
+    def write_block(self, block, ts=None):
+        """提交一块以换行结尾的原始字节，不必先解码成行"""
+        if block and not self.failed:
+            self.submitted += 1
+            self.thread.put(self, (ts or time.time(), block))
+
+    def close(self):
+        """通知写盘线程写完剩余数据后关闭（不阻塞调用方）"""
+        self.thread.put(self, None)
+
+    def wait(self, timeout=None):
+        """等待close提交之前的数据全部写完"""
+        return self.done.wait(timeout)
+
+    def start(self):
+        if self.fts:
+            self.fts_writer = FtsWriter(self.path, self.report)
+
+    def report(self, text):
+        """提示抓取会话；on_error在创建写入器之后才设置，所以调用时再取"""
+        print(text)
+        if self.on_error is not None:
+            self.on_error(text)
+
+    @property
+    def next_line(self):
+        """下一行在整个会话中的全局行号"""
+        return self.line_base + self.lines
+
+    @property
+    def pending(self):
+        """已提交、尚未写入的批数"""
+        return self.submitted - self.written
+
+    def handle(self, ts, lines):
+        self.written += 1
+        # 稀疏索引：每index_every行或每秒最多记录一项
+        if self.indexed_line is None or self.indexed_sec != int(ts) or \
+                self.lines - self.indexed_line >= self.index_every:
+            self.add_index(ts)
+        if isinstance(lines, bytes):
+            data = lines
+            count = data.count(b'\n')
+        else:
+            data = ''.join(lines).encode('utf-8', errors='replace')
+            count = len(lines)
+        if self.fts_writer is not None:
+            self.fts_writer.add(self.line_base + self.lines, lines, ts)
+        self.file.write(data)
+        self.size += len(data)
+        self.lines += count
+        self.last_ts = ts
+        self.latency = time.time() - ts
+
+    def tick(self, now):
+        if now - self.last_flush >= self.flush_interval:
+            self.file.flush()
+            self.index_file.flush()
+            self.last_flush = now
+        if now >= self.rotate_after and ((self.max_bytes and self.size >= self.max_bytes) or
+                                         (self.max_age and self.size and now - self.opened_at >= self.max_age)):
+            self.rotate()
+
+    def finish(self):
+        try:
+            self.close_segment()
+        finally:
+            if self.fts_writer is not None:
+                self.fts_writer.close()
+            self.done.set()
+
+    def fail(self, error):
+        """写盘出错：停止接收新数据，尽量关闭文件，并通知抓取会话"""
+        self.failed = True
+        for f in (self.file, self.index_file):
+            try:
+                f.close()
+            except Exception:
+                pass
+        if self.fts_writer is not None:
+            self.fts_writer.close()
+        self.done.set()
+        print(f"写入日志失败: {str(error)}")
+        if self.on_error is not None:
+            self.on_error(f"写入日志失败，已停止保存: {str(error)}")
+
+    def close_segment(self):
+        # 结尾项记录分段总行数和总字节数
+        self.add_index(self.last_ts)
+        self.file.close()
+        self.index_file.close()
+
+    def reopen_segment(self):
+        """轮转失败后以追加方式重新打开当前分段，行数、大小和起始时间不变"""
+        self.file = open(self.path, 'ab', buffering=self.buffer_size)
+        self.index_file = open(self.path + '.idx', 'a', encoding='utf-8')
+
+    def segment_name(self, opened_at):
+        """按分段起始时间生成轮转后的文件名"""
+        root, ext = os.path.splitext(self.path)
+        stamp = datetime.fromtimestamp(opened_at).strftime("%Y%m%d-%H%M%S")
+        segment = f"{root}.{stamp}{ext}"
+        seq = 1
+        while os.path.exists(segment) or os.path.exists(segment + '.gz'):
+            segment = f"{root}.{stamp}-{seq}{ext}"  # 同一秒内多次轮转
+            seq += 1
+        return segment
+
+    def rotate(self):
+        """当前分段改名为带起始时间的文件，并在后台压缩；改名失败时继续写当前分段，稍后重试"""
+        self.close_segment()
+        segment = self.segment_name(self.opened_at)
+        try:
+            os.replace(self.path, segment)
+            try:
+                os.replace(self.path + '.idx', segment + '.idx')  # 索引偏移始终指向未压缩内容
+            except OSError:
+                os.replace(segment, self.path)
+                raise
+        except OSError as e:
+            # Windows下分段被其他程序（编辑器、归档搜索等）打开时不能改名；结尾项对当前分段只是普通索引项
+            self.reopen_segment()
+            self.rotate_after = time.time() + self.rotate_retry
+            if self.rotate_error is None and self.on_error is not None:
+                self.on_error(f"日志分段轮转失败（文件可能被其他程序占用），继续写入当前分段，稍后重试: {str(e)}")
+            self.rotate_error = e
+            return
+        self.rotate_error = None
+        if self.compress:
+            threading.Thread(target=self.compress_segment, args=(segment,), daemon=True).start()
+        self.line_base += self.lines
+        self.open_segment()
+
+    @staticmethod
+    def compress_segment(segment, member_size=1024 * 1024):
+        """压缩为由独立gzip成员组成的.gz，并在.gzi中记录每个成员的未压缩偏移和压缩偏移
+
+        .idx中的偏移指向未压缩内容；有了.gzi，按索引定位只需从所在成员开始解压，最多解压member_size字节。
+        """
+        try:
+            with open(segment, 'rb') as f_in, open(segment + '.gz', 'wb') as f_out, \
+                    open(segment + '.gzi', 'w', encoding='utf-8') as f_map:
+                offset = 0
+                for chunk in iter(lambda: f_in.read(member_size), b''):
+                    f_map.write(f"{offset}\t{f_out.tell()}\n")
+                    f_out.write(gzip.compress(chunk, compresslevel=6))
+                    offset += len(chunk)
+            os.remove(segment)
+        except Exception as e:
+            print(f"压缩日志分段失败: {str(e)}")
+
+class TcpStreamSink:
+    """把过滤后的行以纯文本行流转发给本机TCP客户端，其他脚本可直接读取实时日志而不必再起adb
+
+    与LogWriter一样提供write(lines, ts)和close()，作为抓取会话的附加输出端；只在读取循环线程中使用。
+    每个客户端各自缓冲，积压超过max_buffer字节时丢弃该客户端的新行，恢复后补发一条丢弃提示，
+    慢客户端不会拖住抓取或其他输出端。
+    """
+    def __init__(self, port=0, host='127.0.0.1', max_buffer=4 * 1024 * 1024, port_tries=32):
+        self.host = host
+        self.port = port
+        self.max_buffer = max_buffer
+        self.port_tries = port_tries
+        self.server = None
+        self.clients = {}  # StreamWriter -> 积压时丢弃的行数
+
+    async def start(self):
+        """开始监听；指定端口被占用时依次尝试后面的端口，0表示由系统分配"""
+        tries = self.port_tries if self.port else 1
+        for attempt in range(tries):
+            try:
+                self.server = await asyncio.start_server(self.on_client, self.host,
+                                                         self.port + attempt if self.port else 0)
+                break
+            except OSError:
+                if attempt == tries - 1:
+                    raise
+        self.port = self.server.sockets[0].getsockname()[1]
+        return f"tcp://{self.host}:{self.port}"
+
+    async def on_client(self, reader, writer):
+        self.clients[writer] = 0
+        try:
+            while await reader.read(4096):
+                pass  # 不接收命令，只等待客户端断开
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            writer.close()
+
+    def write(self, lines, ts=None):
+        if not lines or not self.clients:
+            return
+        data = ''.join(lines).encode('utf-8', errors='replace')
+        for writer, dropped in list(self.clients.items()):
+            if writer.is_closing():
+                self.clients.pop(writer, None)
+            elif writer.transport.get_write_buffer_size() > self.max_buffer:
+                self.clients[writer] = dropped + len(lines)
+            else:
+                if dropped:
+                    writer.write(f"    …… 客户端读取过慢，已丢弃 {dropped} 行\n".encode('utf-8'))
+                    self.clients[writer] = 0
+                writer.write(data)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+        self.clients.clear()
+
+class SegmentIndex:
+    """分段日志的稀疏索引：按时间或行号直接定位到分段内的字节偏移
+
+    同一份索引既供抓取窗口翻阅历史，也供离线工具使用；行号从会话第一个分段起全局连续。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.parsed = {}  # 索引文件 -> 解析结果；已轮转分段的索引不再变化，只解析一次
+        self.current_stat = None
+        self.clock = DeviceClock.load(path)  # 按设备时间跳转时解析行内时间
+        self.reload()
+
+    @staticmethod
+    def read_entries(idx_path):
+        entries = []
+        try:
+            with open(idx_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split('\t')
+                    if len(parts) == 3:
+                        entries.append((int(parts[0]), int(parts[1]), float(parts[2])))
+        except (OSError, ValueError):
+            pass
+        return entries
+
+    @staticmethod
+    def segment_files(path):
+        """返回会话的所有分段（已轮转的在前，当前写入的在最后）"""
+        root, ext = os.path.splitext(path)
+        pattern = re.compile(re.escape(os.path.basename(root)) + r'\.(\d{8}-\d{6})(?:-(\d+))?' +
+                             re.escape(ext) + r'(\.gz)?$')
+        folder = os.path.dirname(path) or '.'
+        rotated = {}
+        for name in os.listdir(folder):
+            m = pattern.match(name)
+            if m:
+                # 按分段起始时间和同一秒内的序号排序；压缩过程中原文件和.gz并存时保留原文件
+                key = (m.group(1), int(m.group(2) or 0))
+                if key not in rotated or not m.group(3):
+                    rotated[key] = os.path.join(folder, name)
+        segments = [rotated[key] for key in sorted(rotated)]
+        return segments + ([path] if os.path.exists(path) else [])
+
+    @staticmethod
+    def open_segment(segment):
+        if segment.endswith('.gz'):
+            return gzip.open(segment, 'rb')
+        return open(segment, 'rb')
+
+    @staticmethod
+    def read_members(gzi_path):
+        """读取.gzi中各gzip成员的(未压缩偏移列表, 压缩偏移列表)，没有时返回None"""
+        starts, positions = [], []
+        try:
+            with open(gzi_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    start, position = line.split('\t')
+                    starts.append(int(start))
+                    positions.append(int(position))
+        except (OSError, ValueError):
+            return None
+        return (starts, positions) if starts else None
+
+    @contextlib.contextmanager
+    def open_at(self, seg, offset):
+        """打开分段并定位到未压缩偏移offset；压缩分段从所在的gzip成员开始解压"""
+        members = seg.get('members')
+        if not seg['path'].endswith('.gz') or members is None:
+            with self.open_segment(seg['path']) as f:
+                f.seek(offset)  # 没有.gzi的旧压缩分段只能从头解压
+                yield f
+            return
+        starts, positions = members
+        k = max(bisect.bisect_right(starts, offset) - 1, 0)
+        with open(seg['path'], 'rb') as raw:
+            raw.seek(positions[k])
+            with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+                f.read(offset - starts[k])
+                yield f
+
+    def parse_segment(self, segment):
+        idx_path = (segment[:-3] if segment.endswith('.gz') else segment) + '.idx'
+        cached = self.parsed.get(idx_path)
+        if cached is None or cached['path'] != segment:
+            entries = cached['entries'] if cached is not None else self.read_entries(idx_path)
+            start = entries[0][2] if entries else os.path.getmtime(segment)
+            members = self.read_members(idx_path[:-4] + '.gzi') if segment.endswith('.gz') else None
+            cached = self.parsed[idx_path] = {'path': segment, 'entries': entries, 'start': start,
+                                              'members': members,
+                                              'lines': [e[0] for e in entries], 'times': [e[2] for e in entries]}
+        return cached
+
+    def current_changed(self):
+        """当前写入分段的索引自上次加载后是否有变化（追加或轮转）"""
+        try:
+            st = os.stat(self.path + '.idx')
+            stat = (st.st_size, st.st_mtime_ns)
+        except OSError:
+            stat = None
+        changed = stat != self.current_stat
+        self.current_stat = stat
+        return changed
+
+    def reload(self):
+        """重新列出分段；已轮转分段沿用解析过的索引，当前分段只在其索引变化时重新解析"""
+        files = self.segment_files(self.path)
+        if self.current_changed():
+            self.parsed.pop(self.path + '.idx', None)
+        self.segments = [self.parse_segment(segment) for segment in files]
+        
+        first_line = 0
+        for seg in self.segments:
+            seg['first_line'] = first_line
+            first_line += seg['lines'][-1] if seg['lines'] else 0
+        self.first_lines = [seg['first_line'] for seg in self.segments]
+        self.starts = [seg['start'] for seg in self.segments]
+
+    def total_lines(self):
+        if not self.segments:
+            return 0
+        last = self.segments[-1]
+        return last['first_line'] + (last['lines'][-1] if last['lines'] else 0)
+
+    def locate_line(self, line_no):
+        """返回(分段, 字节偏移, 需要跳过的行数)"""
+        if not self.segments:
+            return None
+        i = max(bisect.bisect_right(self.first_lines, line_no) - 1, 0)
+        seg = self.segments[i]
+        local = line_no - seg['first_line']
+        j = bisect.bisect_right(seg['lines'], local) - 1
+        if j < 0:
+            return seg['path'], 0, local
+        line, offset, _ = seg['entries'][j]
+        return seg['path'], offset, local - line
+
+    def locate_time(self, ts):
+        """返回(分段, 字节偏移, 全局行号)，指向时间戳不晚于ts的最近索引项"""
+        if not self.segments:
+            return None
+        i = max(bisect.bisect_right(self.starts, ts) - 1, 0)
+        seg = self.segments[i]
+        j = bisect.bisect_right(seg['times'], ts) - 1
+        if j < 0:
+            return seg['path'], 0, seg['first_line']
+        line, offset, _ = seg['entries'][j]
+        return seg['path'], offset, seg['first_line'] + line
+
+    def read_lines(self, line_no, count):
+        """从全局行号line_no开始读取最多count行，可跨分段"""
+        result = []
+        location = self.locate_line(line_no)
+        if location is None:
+            return result
+        segment, offset, skip = location
+        i = [seg['path'] for seg in self.segments].index(segment)
+        for seg in self.segments[i:]:
+            with self.open_at(seg, offset) as f:
+                for raw in f:
+                    if skip:
+                        skip -= 1
+                        continue
+                    result.append(raw.decode('utf-8', errors='replace'))
+                    if len(result) >= count:
+                        return result
+            offset, skip = 0, 0
+        return result
+
+    def entry_time(self, seg, j):
+        """索引项所在行的设备时间，行内没有时间时用换算后的到达时间；按需读取并缓存"""
+        cache = seg.setdefault('device_times', {})
+        ts = cache.get(j)
+        if ts is None:
+            _, offset, arrival = seg['entries'][j]
+            with self.open_at(seg, offset) as f:
+                ts = self.clock.parse(f.readline().decode('utf-8', errors='replace'))[0]
+            if ts is None:
+                ts = self.clock.from_host(arrival)
+            cache[j] = ts
+        return ts
+
+    def line_at_time(self, when):
+        """返回第一条设备时间不早于when的行的全局行号，与FileLineIndex的含义一致
+
+        索引项记录的是到达时间，合并、重新过滤的输出一次写完，到达时间都相同，
+        所以在索引项上按行内解析出的设备时间二分（只读取约log(n)行），再在该区间内逐行比较。
+        """
+        ts = calendar.timegm(when.timetuple())
+        # 已轮转分段的最后一项是记录总行数的结尾项，不对应任何行
+        positions = [(seg, j) for seg in self.segments
+                     for j in range(len(seg['entries']) - (seg['path'] != self.path))]
+        if not positions:
+            return 0
+        lo, hi = 0, len(positions)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry_time(*positions[mid]) <= ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        seg, j = positions[max(lo - 1, 0)]
+        line_no = seg['first_line'] + seg['entries'][j][0]
+        for line in self.read_lines(line_no, 5000):
+            line_ts = self.clock.parse(line)[0]
+            if line_ts is not None and line_ts >= ts:
+                break
+            line_no += 1
+        return line_no
+
+class FileLineIndex:
+    """没有.idx的单个大文件的稀疏行偏移索引，接口与SegmentIndex的读取部分一致
+
+    mmap后在后台线程按块数换行，每块只记一项(行号, 偏移, 块首行时间)，内存只与块数有关；
+    按行号或时间定位时先二分到块，再在块内逐行查找。文件变大时reload会继续往后索引。
+    """
+    def __init__(self, path, block_size=64 * 1024):
+        if path.endswith('.gz'):
+            raise ValueError("压缩文件无法直接按行定位，请先解压")
+        self.path = path
+        self.block_size = block_size
+        self.file = open(path, 'rb')
+        self.mm = None
+        self.size = 0
+        self.lines = [0]    # 每块起始处的行号
+        self.offsets = [0]  # 每块起始处的字节偏移
+        self.times = []     # 每块第一行的时间（设备本地时间），没有时沿用上一块
+        self.clock = DeviceClock.load(path)
+        self.done = False
+        self.closed = False
+        self.thread = None
+        self.reload()
+
+    def reload(self):
+        """文件变大且没有在索引时重新映射并继续索引"""
+        size = os.fstat(self.file.fileno()).st_size
+        if self.closed or size <= self.size or (self.thread is not None and self.thread.is_alive()):
+            return
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = size
+        self.done = False
+        self.thread = threading.Thread(target=self.build, name="FileLineIndex", daemon=True)
+        self.thread.start()
+
+    def line_time(self, mm, offset):
+        end = mm.find(b'\n', offset, offset + 4096)
+        line = mm[offset:end if end != -1 else offset + 4096].decode('utf-8', errors='replace')
+        return self.clock.parse(line)[0]
+
+    def build(self):
+        mm, size = self.mm, self.size
+        pos, line_no = self.offsets[-1], self.lines[-1]
+        last_ts = self.times[-1] if self.times else None
+        while pos < size and not self.closed:
+            if len(self.times) < len(self.offsets):
+                ts = self.line_time(mm, pos)
+                last_ts = ts if ts is not None else last_ts
+                self.times.append(last_ts)
+            stop = min(pos + self.block_size, size)
+            cut = mm.rfind(b'\n', pos, stop) + 1 or mm.find(b'\n', stop) + 1
+            if not cut:
+                break  # 末尾不完整的行等写完后再索引
+            line_no += mm[pos:cut].count(b'\n')
+            # 先追加偏移再追加行号，读取方以行号列表的长度为准
+            self.offsets.append(cut)
+            self.lines.append(line_no)
+            pos = cut
+        self.done = True
+
+    def progress(self):
+        return self.offsets[len(self.lines) - 1] / self.size if self.size else 1.0
+
+    def total_lines(self):
+        total = self.lines[-1]
+        if self.done and self.size > self.offsets[len(self.lines) - 1]:
+            total += 1  # 没有换行结尾的最后一行
+        return total
+
+    def locate(self, line_no):
+        """返回line_no所在行的字节偏移"""
+        mm = self.mm
+        n = len(self.lines)
+        i = max(bisect.bisect_right(self.lines, line_no, 0, n) - 1, 0)
+        offset = self.offsets[i]
+        for _ in range(line_no - self.lines[i]):
+            offset = mm.find(b'\n', offset, self.size) + 1
+            if not offset:
+                return self.size
+        return offset
+
+    def read_lines(self, line_no, count):
+        result = []
+        if self.mm is None:
+            return result
+        # 定位首尾两个偏移后整段解码再按换行切分，不逐行读取
+        start, end = self.locate(line_no), self.locate(line_no + count)
+        parts = self.mm[start:end].decode('utf-8', errors='replace').split('\n')
+        result = [part + '\n' for part in parts[:-1]]
+        if parts[-1]:
+            result.append(parts[-1] + '\n')
+        return result
+
+    def line_at_time(self, when):
+        """返回第一条时间不早于when（设备本地时间）的行号"""
+        ts = calendar.timegm(when.timetuple())
+        n = min(len(self.times), len(self.lines))
+        i = max(bisect.bisect_right(self.times, ts, 0, n) - 1, 0)
+        line_no = self.lines[i]
+        # 在该块及下一块中逐行比较；最后的块以总行数为界（times比lines少最后一项）
+        end = self.lines[i + 2] if i + 2 < len(self.lines) else self.total_lines()
+        for line in self.read_lines(line_no, end - line_no):
+            line_ts = self.clock.parse(line)[0]
+            if line_ts is not None and line_ts >= ts:
+                break
+            line_no += 1
+        return line_no
+
+    def close(self):
+        self.closed = True
+        if self.thread is not None:
+            self.thread.join()
+        if self.mm is not None:
+            self.mm.close()
+        self.file.close()
+
+class FtsIndex:
+    """会话的SQLite FTS5全文索引（会话文件名 + .fts.db），带行号、时间、级别和标签列
+
+    正文用trigram分词，与实时过滤一样按子串、不区分大小写匹配；时间统一为设备本地时间。
+    关键词查询走全文索引，时间范围走ts列上的普通索引，重复查询不再扫描日志。
+    """
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS lines (id INTEGER PRIMARY KEY, line INTEGER, ts REAL, "
+        "level TEXT, tag TEXT, text TEXT)",
+        "CREATE INDEX IF NOT EXISTS lines_ts ON lines (ts)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS lines_fts USING fts5(text, content='lines', "
+        "content_rowid='id', tokenize='trigram')",
+        "CREATE TRIGGER IF NOT EXISTS lines_ai AFTER INSERT ON lines BEGIN "
+        "INSERT INTO lines_fts(rowid, text) VALUES (new.id, new.text); END",
+    ]
+    LEVEL = re.compile(r'^\d{2}-\d{2} [\d:.]+\s+\d+\s+\d+\s+([VDIWEFA])\s|^([VDIWEFA])/')
+    KMSG_LEVEL = 'EEEEWIID'  # 内核优先级0-7对应的logcat级别
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(self.db_path(path))
+        self.conn.execute("PRAGMA journal_mode=WAL")  # 写入时界面仍可查询
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        for sql in self.SCHEMA:
+            self.conn.execute(sql)
+        self.clock = DeviceClock.load(path)
+
+    @staticmethod
+    def db_path(path):
+        return path + '.fts.db'
+
+    def parse(self, line, arrival):
+        """返回(时间, 级别, 标签)；行内没有时间时用到达时间换算成本地时间"""
+        ts = self.clock.parse(line)[0]
+        if ts is None:
+            ts = self.clock.from_host(arrival)
+        m = self.LEVEL.match(line)
+        if m:
+            level = m.group(1) or m.group(2)
+        elif line.startswith('<') and line[1:2].isdigit():
+            level = self.KMSG_LEVEL[int(line[1])]
+        else:
+            level = None
+        return ts, level, DedupStage.tag_of(line)
+
+    def add(self, first_line, lines, arrival):
+        rows = []
+        for i, line in enumerate(lines):
+            text = line.rstrip('\n')
+            ts, level, tag = self.parse(text, arrival)
+            rows.append((first_line + i, ts, level, tag, text))
+        self.conn.executemany("INSERT INTO lines (line, ts, level, tag, text) VALUES (?, ?, ?, ?, ?)", rows)
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    @classmethod
+    def build(cls, path):
+        """为已保存的会话（含已轮转和压缩的分段）重新建立全文索引，返回行数"""
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(cls.db_path(path) + suffix):
+                os.remove(cls.db_path(path) + suffix)
+        index = cls(path)
+        line_no = 0
+        try:
+            for segment in SegmentIndex.segment_files(path):
+                arrival = os.path.getmtime(segment)
+                with SegmentIndex.open_segment(segment) as f:
+                    batch = []
+                    for raw in f:
+                        batch.append(raw.decode('utf-8', errors='replace'))
+                        if len(batch) >= 10000:
+                            index.add(line_no, batch, arrival)
+                            line_no += len(batch)
+                            batch = []
+                    index.add(line_no, batch, arrival)
+                    line_no += len(batch)
+            index.conn.execute("INSERT INTO lines_fts(lines_fts) VALUES ('optimize')")
+        finally:
+            index.close()
+        return line_no
+
+    @classmethod
+    def query(cls, path, keywords='', start=None, end=None, levels='', tag='', limit=1000):
+        """按关键词（逗号分隔，任一命中）、时间范围、级别和标签查询，返回[(行号, 时间, 级别, 标签, 行)]"""
+        if not os.path.exists(cls.db_path(path)):
+            raise FileNotFoundError(f"没有找到全文索引：{cls.db_path(path)}")
+        conditions, params = [], []
+        words = [kw.strip() for kw in keywords.split(',') if kw.strip()]
+        if words and all(len(kw) >= 3 for kw in words):
+            conditions.append("id IN (SELECT rowid FROM lines_fts WHERE lines_fts MATCH ?)")
+            params.append(' OR '.join('"' + kw.replace('"', '""') + '"' for kw in words))
+        elif words:
+            # trigram索引至少需要3个字符，更短的关键词退回逐行LIKE
+            conditions.append('(' + ' OR '.join("text LIKE ? ESCAPE '\\'" for _ in words) + ')')
+            params.extend('%' + re.sub(r'([%_\\])', r'\\\1', kw) + '%' for kw in words)
+        if start is not None:
+            conditions.append("ts >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("ts <= ?")
+            params.append(end)
+        if levels:
+            conditions.append(f"level IN ({', '.join('?' * len(levels))})")
+            params.extend(levels)
+        if tag:
+            conditions.append("tag = ?")
+            params.append(tag)
+        sql = "SELECT line, ts, level, tag, text FROM lines"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY line LIMIT ?"
+        conn = sqlite3.connect(cls.db_path(path))
+        try:
+            return conn.execute(sql, params + [limit]).fetchall()
+        finally:
+            conn.close()
+
+class FtsWriter:
+    """抓取时在独立线程中建立全文索引：解析和插入比写文件慢得多，不能占用所有抓取共用的写盘线程
+
+    队列有上限，跟不上时跳过这批行并提示一次；日志文件本身不受影响，停止后可用“建立全文索引”重建完整索引。
+    数据库在第一批数据到达时才打开，打开失败通过report提示。
+    """
+    def __init__(self, path, report, max_batches=256, commit_interval=1.0):
+        self.path = path
+        self.report = report
+        self.commit_interval = commit_interval
+        self.q = queue.Queue(maxsize=max_batches)
+        self.dropped = 0  # 队列满时跳过的行数，只由写盘线程修改
+        self.failed = False
+        self.thread = threading.Thread(target=self.run, name="FtsWriter", daemon=True)
+        self.thread.start()
+
+    def add(self, first_line, lines, arrival):
+        """由写盘线程调用，不阻塞；lines可以是行列表或以换行结尾的字节块"""
+        if self.failed:
+            return
+        try:
+            self.q.put_nowait((first_line, lines, arrival))
+        except queue.Full:
+            if not self.dropped:
+                self.report("全文索引跟不上日志速度，已跳过部分行，停止后可重新建立全文索引")
+            self.dropped += lines.count(b'\n') if isinstance(lines, bytes) else len(lines)
+
+    def close(self):
+        """提交剩余数据后关闭（队列中的数据仍会处理完）"""
+        self.q.put(None)
+
+    def run(self):
+        index = None
+        last_commit = time.time()
+        while True:
+            try:
+                item = self.q.get(timeout=self.commit_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item and not self.failed:
+                first_line, lines, arrival = item
+                if isinstance(lines, bytes):
+                    lines = LogSource.split_block(lines)
+                try:
+                    if index is None:
+                        index = FtsIndex(self.path)  # SQLite连接只能在创建它的线程中使用
+                    index.add(first_line, lines, arrival)
+                except sqlite3.Error as e:
+                    self.failed = True  # 之后的数据直接丢弃，但继续取队列直到关闭
+                    action = "无法建立全文索引" if index is None else "全文索引出错，已停止建立索引"
+                    self.report(f"{action}: {str(e)}")
+            now = time.time()
+            if index is not None and not self.failed and now - last_commit >= self.commit_interval:
+                index.commit()
+                last_commit = now
+        if index is not None:
+            try:
+                index.close()
+            except sqlite3.Error as e:
+                print(f"关闭全文索引失败: {str(e)}")
+
+class DisplayChannel:
+    """抓取线程到界面线程的有界交接：积压超过上限时按策略削减并计数，界面保持实时、内存有上限
+
+    每项为(行号序列, 行列表, 放入时间, 关键词位置列表)，行号与磁盘上的全局行号一致，削减只影响显示，文件中完整保留。
+    关键词位置在过滤阶段算好，与行一一对应（没有时为None），削减时随行一起抽取或合并。
+    """
+    POLICIES = {'tail': '跳到最新', 'sample': '抽样显示', 'coalesce': '合并积压'}
+
+    def __init__(self, capacity=20000, policy='tail', sample_step=10):
+        self.capacity = capacity
+        self.policy = policy
+        self.sample_step = sample_step
+        self.lock = threading.Lock()
+        self.items = collections.deque()
+        self.pending = 0
+        self.dropped = 0  # 抽样/合并时未显示的行数
+        self.skipped = 0  # 跳到最新时越过的行数
+        self.skip_marker = None
+        self.skip_count = 0
+        self.closed = False
+        self.lag = 0.0  # 最近取出的一批从放入到显示的耗时
+
+    def put(self, first_no, lines, spans=None):
+        if not lines:
+            return
+        with self.lock:
+            self.items.append((range(first_no, first_no + len(lines)), lines, time.time(), spans))
+            self.pending += len(lines)
+            if self.pending > self.capacity:
+                self.shed()
+
+    def put_message(self, text, next_no):
+        """插入一条提示行（不对应磁盘上的行）"""
+        self.put_display([text if text.endswith('\n') else text + '\n'], next_no)
+
+    def put_display(self, lines, next_no, spans=None):
+        """插入只用于显示、不对应磁盘行的一批行（如回放结果）"""
+        if not lines:
+            return
+        with self.lock:
+            self.items.append(([next_no] * len(lines), lines, time.time(), spans))
+            self.pending += len(lines)
+            if self.pending > self.capacity:
+                self.shed()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+    def shed(self):
+        """把积压削减到上限的一半；最新的行总是完整保留"""
+        target = self.capacity // 2
+        if self.policy in ('sample', 'coalesce'):
+            reduced = collections.deque()
+            while self.items and self.pending > target:
+                numbers, lines, ts, spans = self.items.popleft()
+                new_spans = spans
+                if self.policy == 'sample':
+                    new_numbers, new_lines = numbers[::self.sample_step], lines[::self.sample_step]
+                    new_spans = spans and spans[::self.sample_step]
+                elif len(lines) > 3:
+                    marker = f"…… 合并显示，省略 {len(lines) - 2} 行 ……\n"
+                    new_numbers = [numbers[0], numbers[-1], numbers[-1]]
+                    new_lines = [lines[0], marker, lines[-1]]
+                    new_spans = spans and [spans[0], None, spans[-1]]
+                else:
+                    new_numbers, new_lines = numbers, lines
+                self.dropped += len(lines) - len(new_lines)
+                self.pending -= len(lines) - len(new_lines)
+                reduced.append((new_numbers, new_lines, ts, new_spans))
+            reduced.extend(self.items)
+            self.items = reduced
+            if self.pending <= self.capacity:
+                return
+        # 跳到最新：丢弃最旧的积压，只留一条提示（连续跳过时合并到同一条提示中）
+        count = 0
+        next_no = 0
+        while self.items and self.pending > target:
+            item = self.items.popleft()
+            numbers, lines, ts, spans = item
+            self.pending -= len(lines)
+            next_no = numbers[-1] + 1
+            if item is self.skip_marker:
+                count += self.skip_count
+            else:
+                count += len(lines)
+                self.skipped += len(lines)
+        if self.items:
+            next_no = self.items[0][0][0]
+        self.skip_count = count
+        self.skip_marker = ([next_no], [f"…… 界面跟不上，已跳过 {count} 行（文件中完整保留）……\n"], ts, None)
+        self.items.appendleft(self.skip_marker)
+        self.pending += 1
+
+    def drain(self, max_lines):
+        """取出最多约max_lines行，返回(行号, 行, 每行的关键词位置, 是否已结束)"""
+        numbers, lines, spans = [], [], []
+        with self.lock:
+            if not self.items:
+                self.lag = 0.0
+            while self.items and len(lines) < max_lines:
+                item_numbers, item_lines, ts, item_spans = self.items.popleft()
+                numbers.extend(item_numbers)
+                lines.extend(item_lines)
+                spans.extend(item_spans or itertools.repeat(None, len(item_lines)))
+                self.pending -= len(item_lines)
+                self.lag = time.time() - ts
+            finished = self.closed and not self.items
+        return numbers, lines, spans, finished
+
+class CaptureStats:
+    """单个抓取管道的各阶段计数器，用于判断瓶颈在读取、过滤、写盘还是界面"""
+    FIELDS = ['time', 'lines_per_s', 'kb_per_s', 'match_ratio', 'queue_depth',
+              'writer_backlog', 'write_latency_ms', 'ui_lag_ms', 'dropped', 'skipped',
+              'reconnects', 'reconnect_ms', 'suppressed']
+
+    def __init__(self):
+        self.lines_in = 0
+        self.bytes_in = 0
+        self.matched = 0
+        self.reconnects = 0
+        self.reconnect_latency = 0.0  # 最近一次从断开到重新收到数据的耗时
+        self.suppressed = 0  # 被重复折叠或限速丢弃的行数
+        self.last = (time.time(), 0, 0)
+        self.history = collections.deque(maxlen=3600)  # 约一小时的每秒快照
+
+    def snapshot(self, channel, writer):
+        """计算自上次快照以来的速率，并记录到历史中"""
+        now = time.time()
+        last_time, last_lines, last_bytes = self.last
+        elapsed = max(now - last_time, 1e-6)
+        lines_in, bytes_in = self.lines_in, self.bytes_in
+        self.last = (now, lines_in, bytes_in)
+        row = {
+            'time': datetime.fromtimestamp(now).strftime("%H:%M:%S"),
+            'lines_per_s': round((lines_in - last_lines) / elapsed),
+            'kb_per_s': round((bytes_in - last_bytes) / elapsed / 1024, 1),
+            'match_ratio': round(self.matched / lines_in * 100, 2) if lines_in else 0.0,
+            'queue_depth': channel.pending,
+            'writer_backlog': writer.pending,
+            'write_latency_ms': round(writer.latency * 1000),
+            'ui_lag_ms': round(channel.lag * 1000),
+            'dropped': channel.dropped,
+            'skipped': channel.skipped,
+            'reconnects': self.reconnects,
+            'reconnect_ms': round(self.reconnect_latency * 1000),
+            'suppressed': self.suppressed,
+        }
+        self.history.append(row)
+        return row
+
+    @staticmethod
+    def format(row):
+        return (f"读取 {row['lines_per_s']} 行/s {row['kb_per_s']} KB/s | 匹配率 {row['match_ratio']}% | "
+                f"积压 {row['queue_depth']} | 写盘 {row['write_latency_ms']}ms/{row['writer_backlog']} | "
+                f"界面延迟 {row['ui_lag_ms']}ms | 丢弃 {row['dropped']} 跳过 {row['skipped']}" +
+                (f" | 重连 {row['reconnects']}次 {row['reconnect_ms']}ms" if row['reconnects'] else "") +
+                (f" | 折叠/限速 {row['suppressed']} 行" if row['suppressed'] else ""))
+
+    def export(self, path):
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=self.FIELDS)
+            writer.writeheader()
+            writer.writerows(self.history)
+
+class LineFilter:
+    """关键词过滤器；创建后不再修改，运行中的抓取通过整体替换实现原子切换"""
+    def __init__(self, keywords, case_sensitive):
+        self.text = keywords
+        self.keywords = [k.strip() for k in keywords.split(',')]
+        self.case_sensitive = case_sensitive
+        self.needles = self.keywords if case_sensitive else [kw.lower() for kw in self.keywords]
+        self.match_all = not self.needles or '' in self.needles
+        self.byte_needles = [kw.encode('utf-8') for kw in self.needles]
+        # bytes.lower()只折叠ASCII字母；不区分大小写且关键词含非ASCII字符时不能在字节上整块查找
+        self.block_safe = case_sensitive or all(kw.isascii() for kw in self.needles)
+
+    def match(self, line):
+        if self.match_all:
+            return True
+        line_check = line if self.case_sensitive else line.lower()
+        return any(kw in line_check for kw in self.needles)
+
+    def filter(self, lines):
+        match = self.match
+        return [line for line in lines if match(line)]
+
+    def filter_block(self, lines, block=None):
+        """过滤一整批行；有对应的原始字节块时直接在整块上查找，只解码匹配的行"""
+        if self.match_all:
+            return list(lines)
+        if block is None or (not self.block_safe and lines is not None):
+            return self.filter(lines)
+        return [line.decode('utf-8', errors='replace') for _, line in self.scan(block)]
+
+    def spans(self, line):
+        """返回行内所有关键词出现的位置[(起, 止, 关键词序号)]，供界面高亮"""
+        result = []
+        if self.match_all:
+            return result
+        line_check = line if self.case_sensitive else line.lower()
+        origin = None
+        if len(line_check) != len(line):
+            # 个别字符（如'İ'）小写后变长，查到的位置要换算回原文中的字符位置
+            origin = [i for i, ch in enumerate(line) for _ in ch.lower()]
+        for k, needle in enumerate(self.needles):
+            pos = line_check.find(needle)
+            while pos != -1:
+                end = pos + len(needle)
+                if origin is None:
+                    result.append((pos, end, k))
+                else:
+                    result.append((origin[pos], origin[end - 1] + 1, k))
+                pos = line_check.find(needle, end)
+        return result
+
+    def line_spans(self, lines):
+        """一批行各自的关键词位置，在过滤阶段随行一起交给界面；不过滤时返回None"""
+        if self.match_all:
+            return None
+        spans = self.spans
+        return [spans(line) for line in lines]
+
+    def scan(self, block):
+        """在以换行结尾的一大块字节中查找匹配行，返回[(行起始偏移, 行字节)]
+
+        直接在整块上查找关键词再取出所在行，比逐行解码判断快得多；
+        不区分大小写且关键词含非ASCII字符时，退回逐行解码后用match判断，结果与match一致。
+        """
+        if self.match_all:
+            result, start = [], 0
+            for line in block.splitlines(keepends=True):
+                result.append((start, line))
+                start += len(line)
+            return result
+        if not self.block_safe:
+            result, start = [], 0
+            for line in block.splitlines(keepends=True):
+                if self.match(line.decode('utf-8', errors='replace')):
+                    result.append((start, line))
+                start += len(line)
+            return result
+        hay = block if self.case_sensitive else block.lower()
+        spans = set()
+        for needle in self.byte_needles:
+            pos = hay.find(needle)
+            while pos != -1:
+                start = hay.rfind(b'\n', 0, pos) + 1
+                end = hay.find(b'\n', pos)
+                end = len(hay) if end == -1 else end + 1
+                spans.add((start, end))
+                pos = hay.find(needle, end)  # 同一行只取一次
+        return [(start, block[start:end]) for start, end in sorted(spans)]
+
+class TriggerStage:
+    """触发式抓取：平时只在内存中保留最近的原始行，关键词命中时输出命中前后的上下文
+
+    命中前保留最多pre_lines行且不早于pre_seconds秒；命中后继续输出，
+    直到post_lines行或post_seconds秒先到为止，期间再次命中会重新计时。
+    """
+    def __init__(self, pre_lines=500, pre_seconds=5.0, post_lines=500, post_seconds=5.0):
+        self.pre_lines = pre_lines
+        self.pre_seconds = pre_seconds
+        self.post_lines = post_lines
+        self.post_seconds = post_seconds
+        self.ring = collections.deque(maxlen=pre_lines or None)  # (到达时间, 行)
+        self.post_left = 0
+        self.post_deadline = 0.0
+        self.triggers = 0
+
+    def process(self, lines, flt, now):
+        out = []
+        for line in lines:
+            if flt.match(line):
+                if self.post_left <= 0 or now >= self.post_deadline:
+                    # 新的一次触发：先输出命中前的上下文
+                    self.triggers += 1
+                    out.append(f"======== {datetime.now().strftime('%H:%M:%S')} 第{self.triggers}次触发 ========\n")
+                    out.extend(entry[1] for entry in self.ring if now - entry[0] <= self.pre_seconds)
+                    self.ring.clear()
+                out.append(line)
+                self.post_left = self.post_lines
+                self.post_deadline = now + self.post_seconds
+            elif self.post_left > 0 and now < self.post_deadline:
+                out.append(line)
+                self.post_left -= 1
+            elif self.pre_lines:
+                self.ring.append((now, line))
+        # 按时间淘汰过旧的前置行
+        while self.ring and now - self.ring[0][0] > self.pre_seconds:
+            self.ring.popleft()
+        return out
+
+class KmsgFilter:
+    """内核日志的级别和驱动前缀过滤：按行首<级别>做整数比较，按消息开头做前缀比较，不做子串查找"""
+    LEVELS = ['0 EMERG', '1 ALERT', '2 CRIT', '3 ERR', '4 WARNING', '5 NOTICE', '6 INFO', '7 DEBUG']
+
+    def __init__(self, max_level=7, prefixes=()):
+        self.max_level = max_level
+        self.prefixes = tuple(prefixes)
+
+    def match(self, line):
+        end = line.find('>', 1, 5)
+        if not line.startswith('<') or end < 0:
+            return True  # 标记行等非内核记录不过滤
+        try:
+            level = int(line[1:end]) & 7
+        except ValueError:
+            return True
+        if level > self.max_level:
+            return False
+        if not self.prefixes:
+            return True
+        pos = line.find('] ', end) + 2
+        if line[pos + 2:pos + 3] == '-' and line[pos + 8:pos + 9] == ':':
+            pos += 19  # 跳过KmsgSource附加的设备本地时间
+        return line.startswith(self.prefixes, pos)
+
+    def filter(self, lines):
+        match = self.match
+        return [line for line in lines if match(line)]
+
+class DedupStage:
+    """刷屏抑制：折叠最近窗口内的重复行（忽略时间戳），并按标签限速；内存占用有上限
+
+    window为记住的最近不同行数，1表示只折叠连续重复；被折叠的次数在该行移出窗口、
+    空闲flush_seconds秒或收尾时以一条汇总行输出。tag_rate为每个标签每秒最多输出的行数，0表示不限速。
+    """
+    STAMP = re.compile(r'^(?:\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d+|'
+                       r'(?:<\d+>)?\[\s*\d+\.\d+\](?:\s*\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d+)?)\s*')
+    TAG = re.compile(r'^\s*\d+\s+\d+\s+[VDIWEFA]\s+(.*?)\s*:|^[VDIWEFA]/(.*?)\s*\(|^([\w.-]{1,32}):')
+
+    def __init__(self, window=8, tag_rate=0, flush_seconds=1.0, max_tags=1024):
+        self.window = max(window, 1)
+        self.tag_rate = tag_rate
+        self.flush_seconds = flush_seconds
+        self.max_tags = max_tags
+        self.recent = collections.OrderedDict()  # 去掉时间戳的行 -> [折叠次数, 最后出现时间]
+        self.tags = collections.OrderedDict()    # 标签 -> [令牌数, 上次补充时间, 丢弃行数]
+        self.next_flush = 0.0
+        self.suppressed = 0
+
+    @classmethod
+    def tag_of(cls, line):
+        """取出一行的logcat标签或内核子系统前缀，没有时返回None"""
+        match = cls.TAG.match(cls.STAMP.sub('', line, count=1))
+        if not match:
+            return None
+        return match.group(1) or match.group(2) or match.group(3)
+
+    @staticmethod
+    def summary_repeat(text, count):
+        return f"    …… 重复 {count} 次: {text[:160].rstrip()}\n"
+
+    @staticmethod
+    def summary_limit(tag, count, rate):
+        return f"    …… 标签 {tag} 超过 {rate} 行/秒，已丢弃 {count} 行\n"
+
+    def allow(self, text, now, out):
+        """按标签令牌桶限速，返回该行是否放行"""
+        match = self.TAG.match(text)
+        if not match:
+            return True
+        tag = match.group(1) or match.group(2) or match.group(3)
+        bucket = self.tags.get(tag)
+        if bucket is None:
+            bucket = self.tags[tag] = [float(self.tag_rate), now, 0]
+            if len(self.tags) > self.max_tags:
+                old_tag, old = self.tags.popitem(last=False)
+                if old[2]:
+                    out.append(self.summary_limit(old_tag, old[2], self.tag_rate))
+        else:
+            self.tags.move_to_end(tag)
+            bucket[0] = min(float(self.tag_rate), bucket[0] + (now - bucket[1]) * self.tag_rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            bucket[2] += 1
+            return False
+        bucket[0] -= 1
+        if bucket[2]:
+            out.append(self.summary_limit(tag, bucket[2], self.tag_rate))
+            bucket[2] = 0
+        return True
+
+    def process(self, lines, now):
+        out = []
+        suppressed = 0
+        for line in lines:
+            text = self.STAMP.sub('', line, count=1)
+            entry = self.recent.get(text)
+            if entry is not None:
+                entry[0] += 1
+                entry[1] = now
+                self.recent.move_to_end(text)
+                suppressed += 1
+                continue
+            if self.tag_rate and not self.allow(text, now, out):
+                suppressed += 1
+                continue
+            self.recent[text] = [0, now]
+            if len(self.recent) > self.window:
+                # 被挤出窗口的行的汇总紧跟在它的重复之后，先于这一新行输出
+                old_text, old = self.recent.popitem(last=False)
+                if old[0]:
+                    out.append(self.summary_repeat(old_text, old[0]))
+            out.append(line)
+        self.suppressed += suppressed
+        if now >= self.next_flush:
+            out.extend(self.tick(now))
+        return out
+
+    def tick(self, now):
+        """输出空闲超过flush_seconds秒的汇总；上游没有新数据时由读取循环每秒调用一次"""
+        self.next_flush = now + self.flush_seconds
+        return self.flush(now - self.flush_seconds)
+
+    def flush(self, before=None):
+        """输出最后出现早于before（None表示全部）的折叠和限速汇总"""
+        out = []
+        for text, entry in self.recent.items():
+            if entry[0] and (before is None or entry[1] <= before):
+                out.append(self.summary_repeat(text, entry[0]))
+                entry[0] = 0
+        for tag, bucket in self.tags.items():
+            if bucket[2] and (before is None or bucket[1] <= before):
+                out.append(self.summary_limit(tag, bucket[2], self.tag_rate))
+                bucket[2] = 0
+        return out
+
+class RateMonitor:
+    """按标签和关键词统计每秒行数，与指数平滑的基线比较，实时标出突增和静默
+
+    标签基数可能很高，每秒计数和基线都放在固定大小的count-min sketch中；
+    只对最近出现过的有限个标签逐个判断，关键词数量少，直接精确计数。
+    """
+    def __init__(self, keywords=(), spike_factor=5.0, silence=10.0, min_rate=5.0,
+                 warmup=30, alpha=0.05, depth=4, width=2048, max_tags=512):
+        self.keywords = [kw for kw in keywords if kw]
+        self.spike_factor = spike_factor
+        self.silence = silence
+        self.min_rate = min_rate  # 低于该速率的标签不报突增，基线低于它的不报静默
+        self.warmup = warmup
+        self.alpha = alpha
+        self.width = width
+        self.current = [[0] * width for _ in range(depth)]
+        self.baseline = [[0.0] * width for _ in range(depth)]
+        self.keyword_current = dict.fromkeys(self.keywords, 0)
+        self.keyword_baseline = dict.fromkeys(self.keywords, 0.0)
+        self.keyword_seen = {}
+        self.tags = collections.OrderedDict()  # 标签 -> [最后出现时间, 状态]
+        self.max_tags = max_tags
+        self.states = {}  # 关键词 -> 状态
+        self.second = None
+        self.seconds = 0  # 已经并入基线的秒数
+        self.anomalies = 0
+
+    def cells(self, tag):
+        return [hash((row, tag)) % self.width for row in range(len(self.current))]
+
+    @staticmethod
+    def estimate(sketch, cells):
+        return min(row[cell] for row, cell in zip(sketch, cells))
+
+    def observe(self, lines, matched, flt, now):
+        """累加一批原始行的标签计数和匹配行的关键词计数"""
+        alerts = self.tick(now)
+        counts = collections.Counter(map(DedupStage.tag_of, lines))
+        counts.pop(None, None)
+        for tag, count in counts.items():
+            for row, cell in zip(self.current, self.cells(tag)):
+                row[cell] += count
+            if tag in self.tags:
+                self.tags[tag][0] = now
+                self.tags.move_to_end(tag)
+            else:
+                self.tags[tag] = [now, 'normal']
+                if len(self.tags) > self.max_tags:
+                    self.tags.popitem(last=False)
+        if self.keywords and matched:
+            checks = matched if flt.case_sensitive else [line.lower() for line in matched]
+            for kw, needle in zip(flt.keywords, flt.needles):
+                if kw not in self.keyword_current:
+                    continue
+                count = sum(1 for line in checks if needle in line)
+                if count:
+                    self.keyword_current[kw] += count
+                    self.keyword_seen[kw] = now
+        return alerts
+
+    def tick(self, now):
+        """每跨过一秒判断一次并把这一秒并入基线，返回新出现的异常/恢复提示"""
+        second = int(now)
+        if self.second is None:
+            self.second = second
+        if second <= self.second:
+            return []
+        alerts = []
+        if self.seconds >= self.warmup:
+            silent = []
+            for tag, entry in self.tags.items():
+                cells = self.cells(tag)
+                for alert in self.judge(f"标签 {tag}", entry, self.estimate(self.current, cells),
+                                        self.estimate(self.baseline, cells), now - entry[0]):
+                    (silent if entry[1] == 'silent' else alerts).append((tag, alert))
+            if len(silent) > 5:
+                # 整个日志流停住时合并成一条，避免每个标签各报一次
+                names = ', '.join(tag for tag, alert in silent[:10])
+                silent = [(None, f"速率静默: {len(silent)} 个标签同时 {self.silence:.0f} 秒无日志 ({names} ...)")]
+            alerts = [alert for tag, alert in alerts + silent]
+            for kw in self.keywords:
+                entry = [self.keyword_seen.get(kw, 0.0), self.states.get(kw, 'normal')]
+                alerts.extend(self.judge(f"关键词 {kw}", entry, self.keyword_current[kw],
+                                         self.keyword_baseline[kw], now - entry[0]))
+                self.states[kw] = entry[1]
+        # 并入基线：前期用累计平均，之后按alpha指数平滑；中间没有数据的秒按0计，合并为一次衰减
+        alpha = max(self.alpha, 1.0 / (self.seconds + 1))
+        decay = 1.0 - alpha
+        self.seconds += 1
+        for _ in range(second - self.second - 1):
+            decay *= 1.0 - max(self.alpha, 1.0 / (self.seconds + 1))
+            self.seconds += 1
+        for base_row, cur_row in zip(self.baseline, self.current):
+            base_row[:] = [base * decay + count * alpha for base, count in zip(base_row, cur_row)]
+            cur_row[:] = [0] * self.width
+        for kw in self.keywords:
+            self.keyword_baseline[kw] = self.keyword_baseline[kw] * decay + self.keyword_current[kw] * alpha
+            self.keyword_current[kw] = 0
+        self.second = second
+        self.anomalies += sum(1 for text in alerts if "恢复" not in text)
+        return alerts
+
+    def judge(self, name, entry, rate, base, idle):
+        """根据这一秒的速率和基线更新entry中的状态，状态变化时返回提示"""
+        state = entry[1]
+        if rate >= self.min_rate and rate > base * self.spike_factor:
+            new_state = 'spike'
+        elif idle >= self.silence and base >= self.min_rate / self.silence:
+            new_state = 'silent'
+        elif state == 'spike' and rate > base * 2:
+            new_state = 'spike'  # 回落到基线两倍以内才算恢复，避免来回跳变
+        else:
+            new_state = 'normal'
+        if new_state == state:
+            return []
+        entry[1] = new_state
+        if new_state == 'spike':
+            return [f"速率突增: {name} {rate} 行/秒，基线 {base:.1f} 行/秒"]
+        if new_state == 'silent':
+            return [f"速率静默: {name} 已 {idle:.0f} 秒无日志，基线 {base:.1f} 行/秒"]
+        return [f"速率恢复: {name} {rate} 行/秒，基线 {base:.1f} 行/秒"]
+
+class CaptureSession:
+    """单个抓取窗口：订阅上游日志流，按关键词过滤后交给写盘线程和界面通道"""
+    def __init__(self, window_id, log_type, keywords, case_sensitive, writer, channel):
+        self.window_id = window_id
+        self.log_type = log_type
+        self.filter = LineFilter(keywords, case_sensitive)
+        self.writer = writer
+        self.channel = channel
+        self.line_no = writer.next_line  # 下一条匹配行在磁盘上的全局行号
+        writer.on_error = self.notify
+        self.stats = CaptureStats()
+        self.serial = None    # 绑定的设备序列号，None表示adb默认设备
+        self.raw_path = None  # 非空时上游同时保存未过滤的原始日志
+        self.trigger = None   # 非空时为触发式抓取，只输出命中前后的上下文
+        self.file_dedup = None  # 写入文件前的刷屏抑制，None表示不折叠
+        self.view_dedup = None  # 送往界面前的刷屏抑制，与文件侧互相独立
+        self.monitor = None     # 非空时按标签和关键词检测速率异常
+        self.kmsg_filter = None  # 非空时先按内核日志级别和驱动前缀过滤
+        self.sinks = []  # 附加输出端，与写盘线程接收相同的行，接口为write(lines, ts)和close()
+        self.source = None
+        self.closed = False
+
+    def check_filter(self, line):
+        return self.filter.match(line)
+
+    def feed(self, lines, nbytes=0, block=None):
+        """处理上游分发的一批行；block为这批行对应的原始字节（以换行结尾），可整块过滤"""
+        nlines = len(lines)
+        if self.kmsg_filter is not None:
+            lines = self.kmsg_filter.filter(lines)
+            block = None
+        if self.trigger is not None:
+            matched = self.trigger.process(lines, self.filter, time.time())
+        else:
+            matched = self.filter.filter_block(lines, block)
+        self.stats.lines_in += nlines
+        self.stats.bytes_in += nbytes
+        self.stats.matched += len(matched)
+        now = time.time()
+        self.output(matched, now)
+        if self.monitor is not None:
+            for alert in self.monitor.observe(lines, matched, self.filter, now):
+                self.mark(alert)
+
+    def needs_all_lines(self):
+        """触发式抓取和速率检测要看到全部原始行，不能只接收匹配结果"""
+        return self.trigger is not None or self.monitor is not None or self.kmsg_filter is not None
+
+    def feed_matched(self, nlines, matched, nbytes=0):
+        """接收过滤进程已经过滤好的一批行"""
+        self.stats.lines_in += nlines
+        self.stats.bytes_in += nbytes
+        self.stats.matched += len(matched)
+        self.output(matched, time.time())
+
+    def tick(self, now):
+        """由界面每秒触发一次、在读取循环中执行：上游没有数据时也能发现静默，并输出空闲的折叠汇总"""
+        if self.closed:
+            return
+        if self.monitor is not None:
+            for alert in self.monitor.tick(now):
+                self.mark(alert)
+        if self.file_dedup is not None:
+            tail = self.file_dedup.tick(now)
+            if tail:
+                self.write_file(tail, now)
+                self.line_no += len(tail)
+        if self.view_dedup is not None:
+            self.channel.put_display(self.view_dedup.tick(now), self.line_no)
+
+    def output(self, matched, now):
+        """经过各自的刷屏抑制后，整批交给写盘线程和界面通道"""
+        file_lines = matched
+        if self.file_dedup is not None:
+            file_lines = self.file_dedup.process(matched, now)
+        view_lines = matched
+        if self.view_dedup is not None:
+            view_lines = self.view_dedup.process(matched, now)
+        self.stats.suppressed = sum(stage.suppressed for stage in (self.file_dedup, self.view_dedup)
+                                    if stage is not None)
+        # 刷新、轮转与索引都在写盘线程中完成
+        if file_lines:
+            self.write_file(file_lines, now)
+        # 关键词位置在这里随批算好，界面只按位置上色，不再查找
+        if view_lines is file_lines:
+            self.channel.put(self.line_no, file_lines, self.filter.line_spans(file_lines))
+        elif view_lines:
+            # 界面侧单独折叠时行数与磁盘不再一一对应，统一归到本批第一行的位置
+            self.channel.put_display(view_lines, self.line_no, self.filter.line_spans(view_lines))
+        self.line_no += len(file_lines)
+
+    def close(self):
+        """输出剩余的折叠汇总，通知写盘线程收尾，并通知界面线程关闭窗口"""
+        if self.closed:
+            return
+        self.closed = True
+        if self.file_dedup is not None:
+            tail = self.file_dedup.flush()
+            self.write_file(tail, time.time())
+            self.line_no += len(tail)
+        if self.view_dedup is not None:
+            self.channel.put_display(self.view_dedup.flush(), self.line_no)
+        self.writer.close()
+        for sink in self.sinks:
+            sink.close()
+        self.channel.close()
+
+    def write_file(self, lines, now):
+        """写盘线程和各附加输出端收到同样的行，各自缓冲"""
+        self.writer.write(lines, now)
+        for sink in self.sinks:
+            sink.write(lines, now)
+
+    async def open_sinks(self):
+        """在读取循环中启动需要监听的输出端，把地址作为标记行写出"""
+        for sink in list(self.sinks):
+            if not hasattr(sink, 'start'):
+                continue
+            try:
+                address = await sink.start()
+                self.mark(f"过滤结果同时转发到 {address}")
+            except OSError as e:
+                self.sinks.remove(sink)
+                self.mark(f"输出端启动失败: {str(e)}")
+
+    def subscriptions(self):
+        """需要挂到上游的订阅者"""
+        return [self]
+
+    def notify(self, text):
+        self.channel.put_message(text, self.line_no)
+
+    def mark(self, text):
+        """写入一条带时间的标记行，文件和界面中都会出现"""
+        marker = f"======== {datetime.now().strftime('%H:%M:%S')} {text} ========\n"
+        self.write_file([marker], time.time())
+        self.channel.put(self.line_no, [marker])
+        self.line_no += 1
+
+    def swap_filter(self, new_filter, replay=True):
+        """在读取循环中替换过滤器，不重启上游；可选用新关键词重跑上游保留的最近原始行"""
+        self.filter = new_filter
+        self.mark(f"关键词切换为: {new_filter.text or '(全部)'}")
+        if replay and self.source is not None:
+            recent = self.source.recent_lines()
+            matched = new_filter.filter(recent)
+            self.channel.put_message(f"---- 最近 {len(recent)} 行原始日志中匹配新关键词的 {len(matched)} 行（仅显示）----",
+                                     self.line_no)
+            self.channel.put_display(matched, self.line_no, new_filter.line_spans(matched))
+            self.channel.put_message("---- 回放结束，以下为实时日志 ----", self.line_no)
+
+class DeviceClock:
+    """把logcat时间和内核单调时间统一换算为设备本地时间（按UTC计算的秒数）"""
+    LOGCAT_TIME = re.compile(r'^(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})\.(\d+)')
+    KMSG_TIME = re.compile(r'^(?:<\d+>)?\[\s*(\d+\.\d+)\]')
+    KMSG_WALL = re.compile(r' \d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3} ')  # KmsgSource在单调时间后附加的本地时间
+
+    def __init__(self, boot_local=None, year=None, offset=None):
+        self.boot_local = boot_local  # 开机时刻的设备本地时间
+        self.year = year or datetime.now().year
+        self.offset = offset  # 设备本地时间减本机时间戳，用于换算没有时间戳的行的到达时间
+
+    @classmethod
+    def query(cls, serial=None):
+        """通过adb读取设备uptime和本地时间，失败时用本机时间近似"""
+        cmd = ['adb'] + (['-s', serial] if serial else []) + \
+            ['shell', "cat /proc/uptime; date '+%Y-%m-%d %H:%M:%S'"]
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, timeout=5)
+            uptime_line, date_line = result.stdout.strip().splitlines()[-2:]
+            uptime = float(uptime_line.split()[0])
+            now = datetime.strptime(date_line.strip(), "%Y-%m-%d %H:%M:%S")
+            device_now = calendar.timegm(now.timetuple())
+            return cls(device_now - uptime, now.year, device_now - time.time())
+        except Exception as e:
+            print(f"读取设备时钟失败: {str(e)}")
+            return cls(None)
+
+    def save(self, path):
+        with open(path + '.clock', 'w', encoding='utf-8') as f:
+            json.dump({'boot_local': self.boot_local, 'year': self.year, 'offset': self.offset}, f)
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path + '.clock', 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return cls(data.get('boot_local'), data.get('year'), data.get('offset'))
+        except (OSError, ValueError):
+            year = datetime.fromtimestamp(os.path.getmtime(path)).year if os.path.exists(path) else None
+            return cls(None, year)
+
+    def parse(self, line):
+        """返回(时间, 是否需要补上设备本地时间)，无法解析时返回(None, False)
+
+        由内核单调时间换算出的时间需要在合并输出中补上，KmsgSource改写过的行已自带本地时间则不需要。
+        """
+        m = self.LOGCAT_TIME.match(line)
+        if m:
+            month, day, hour, minute, second, frac = m.groups()
+            try:
+                ts = calendar.timegm((self.year, int(month), int(day), int(hour), int(minute), int(second)))
+            except ValueError:
+                return None, False
+            return ts + float('0.' + frac), False
+        m = self.KMSG_TIME.match(line)
+        if m and self.boot_local is not None:
+            return self.boot_local + float(m.group(1)), not self.KMSG_WALL.match(line, m.end())
+        return None, False
+
+    def from_host(self, t):
+        """把本机时间戳（如行的到达时间）换算为设备本地时间；不知道两边时差时按本机时区近似"""
+        if self.offset is not None:
+            return t + self.offset
+        return calendar.timegm(time.localtime(t)) + t % 1
+
+    @staticmethod
+    def format(ts):
+        return time.strftime("%m-%d %H:%M:%S", time.gmtime(ts)) + f".{int(ts % 1 * 1000):03d}"
+
+    def entries(self, lines, tag, order=0):
+        """把(行, 到达时间)序列转换为可归并的(时间, 来源序号, 行)
+
+        无时间戳的续行沿用上一行的时间；整个来源都没有时间戳（如qsee_log）时用换算后的到达时间。
+        """
+        last_ts = None
+        for line, arrival in lines:
+            ts, mono = self.parse(line)
+            if ts is None:
+                ts = last_ts if last_ts is not None else self.from_host(arrival)
+            else:
+                last_ts = ts
+            prefix = f"[{tag}] {self.format(ts)} " if mono else f"[{tag}] "
+            yield ts, order, prefix + line
+
+class TimelineInput:
+    """时间线的一路输入：按该来源的关键词过滤后交给LiveTimeline归并
+
+    只提供上游LogSource需要的订阅者接口（feed、needs_all_lines、close、notify、mark、stats），
+    不继承CaptureSession：写盘、界面通道和输出端都属于LiveTimeline。
+    """
+    def __init__(self, timeline, log_type, keywords, case_sensitive):
+        self.timeline = timeline
+        self.window_id = timeline.window_id
+        self.serial = timeline.serial
+        self.log_type = log_type
+        self.filter = LineFilter(keywords, case_sensitive)
+        self.source = None
+        self.closed = False
+        self.last_ts = None
+        self.received = False  # 收到过行却一直没有可解析的时间（如qsee_log）的来源不参与水位线
+        self.last_arrival = time.time()  # 刚启动的来源在hold秒内也会挡住水位线
+
+    def feed(self, lines, nbytes=0, block=None):
+        matched = self.filter.filter_block(lines, block)
+        stats = self.stats
+        stats.lines_in += len(lines)
+        stats.bytes_in += nbytes
+        stats.matched += len(matched)
+        self.timeline.push(self, matched, lines)
+
+    def needs_all_lines(self):
+        return True  # 原始行用于推进水位线
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.timeline.input_closed()
+
+    def notify(self, text):
+        self.timeline.channel.put_message(f"[{self.log_type}] {text}", self.timeline.line_no)
+
+    def mark(self, text):
+        self.notify(f"======== {datetime.now().strftime('%H:%M:%S')} {text} ========")
+
+    @property
+    def stats(self):
+        return self.timeline.stats
+
+class LiveTimeline:
+    """实时合并时间线：多个来源的行按设备时间做k路堆归并后输出到同一窗口
+
+    水位线取各个仍有数据的来源最新时间的最小值，早于水位线的行才输出；
+    某来源超过hold秒没有数据时不再阻挡其他来源。没有时间戳的来源按到达时间（换算为设备时间）排序，
+    不参与水位线。clock为None时由LogTools在读取循环中读取设备时钟后再挂到上游。
+    """
+    def __init__(self, window_id, inputs, clock, writer, channel, hold=1.0, serial=None):
+        self.window_id = window_id
+        self.serial = serial
+        self.clock = clock
+        self.writer = writer
+        self.channel = channel
+        self.hold = hold
+        self.line_no = writer.next_line
+        writer.on_error = lambda text: channel.put_message(text, self.line_no)
+        self.stats = CaptureStats()
+        self.heap = []
+        self.seq = itertools.count()
+        self.tick_handle = None
+        self.closed = False
+        self.inputs = [TimelineInput(self, *config) for config in inputs]
+
+    def subscriptions(self):
+        return self.inputs
+
+    def push(self, inp, lines, raw_lines=()):
+        inp.last_arrival = time.time()
+        inp.received = inp.received or bool(raw_lines)
+        arrival = self.clock.from_host(inp.last_arrival)
+        for line in lines:
+            ts, mono = self.clock.parse(line)
+            if ts is None:
+                ts = inp.last_ts if inp.last_ts is not None else arrival
+            else:
+                inp.last_ts = ts
+            prefix = f"[{inp.log_type}] {self.clock.format(ts)} " if mono else f"[{inp.log_type}] "
+            heapq.heappush(self.heap, (ts, next(self.seq), prefix + line))
+        # 未匹配的行也推进该来源的时间，避免过滤掉的来源拖住水位线
+        for line in itertools.islice(reversed(raw_lines), 20):
+            ts, _ = self.clock.parse(line)
+            if ts is not None:
+                inp.last_ts = max(ts, inp.last_ts or ts)
+                break
+        self.emit()
+
+    def emit(self, final=False):
+        self.tick_handle = None
+        now = time.time()
+        marks = [inp.last_ts if inp.last_ts is not None else float('-inf') for inp in self.inputs
+                 if not inp.closed and now - inp.last_arrival < self.hold
+                 and (inp.last_ts is not None or not inp.received)]
+        watermark = min(marks) if marks else float('inf')
+        out = []
+        while self.heap and (final or self.heap[0][0] <= watermark):
+            out.append(heapq.heappop(self.heap)[2])
+        if out:
+            self.writer.write(out, now)
+            self.channel.put(self.line_no, out)
+            self.line_no += len(out)
+        if self.heap and not final and self.tick_handle is None:
+            # 来源都安静下来时，由定时器把剩余的行推出去
+            self.tick_handle = asyncio.get_running_loop().call_later(self.hold, self.emit)
+
+    def input_closed(self):
+        if all(inp.closed for inp in self.inputs):
+            self.close()
+        else:
+            self.emit()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.tick_handle is not None:
+            self.tick_handle.cancel()
+        self.emit(final=True)
+        self.writer.close()
+        self.channel.close()
+
+def merge_log_files(paths, output_path):
+    """离线合并已保存的日志会话：逐段流式读取，按时间做k路堆归并，不整体载入内存"""
+    def session_lines(path):
+        """逐行产出(行, 到达时间)，到达时间取自索引中不晚于该行的最近一项"""
+        index = SegmentIndex(path)
+        segments = index.segments or [{'path': path, 'entries': []}]
+        for seg in segments:
+            entries = seg['entries']
+            arrival = entries[0][2] if entries else os.path.getmtime(seg['path'])
+            j = 0
+            with SegmentIndex.open_segment(seg['path']) as f:
+                for line_no, raw in enumerate(f):
+                    while j < len(entries) and entries[j][0] <= line_no:
+                        arrival = entries[j][2]
+                        j += 1
+                    yield raw.decode('utf-8', errors='replace'), arrival
+
+    streams = []
+    for order, path in enumerate(paths):
+        clock = DeviceClock.load(path)
+        tag = os.path.splitext(os.path.basename(path))[0]
+        streams.append(clock.entries(session_lines(path), tag, order))
+    
+    writer = LogWriter(output_path, max_bytes=0, max_age=0)
+    start_line = writer.next_line
+    batch = []
+    for ts, order, line in heapq.merge(*streams):
+        batch.append(line)
+        if len(batch) >= 5000:
+            writer.write(batch)
+            batch = []
+    writer.write(batch)
+    writer.close()
+    writer.wait()
+    return start_line
+
+def refilter_segment(segment, keywords, case_sensitive):
+    """进程池工作函数：按块扫描一个原始日志分段，返回匹配的行"""
+    flt = LineFilter(keywords, case_sensitive)
+    matched = []
+    tail = b''
+    with SegmentIndex.open_segment(segment) as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            block = tail + block
+            cut = block.rfind(b'\n') + 1
+            tail = block[cut:]
+            matched.extend(line.decode('utf-8', errors='replace') for _, line in flt.scan(block[:cut]))
+    if tail:
+        matched.extend(line.decode('utf-8', errors='replace') + '\n' for _, line in flt.scan(tail))
+    return matched
+
+def refilter_session(raw_path, keywords, case_sensitive, output_path, workers=None):
+    """用新关键词重新过滤已保存的原始日志会话，各分段在进程池中并行扫描，结果按顺序写出"""
+    segments = [seg['path'] for seg in SegmentIndex(raw_path).segments]
+    writer = LogWriter(output_path, max_bytes=0, max_age=0)
+    start_line = writer.next_line
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            for matched in pool.map(refilter_segment, segments,
+                                    itertools.repeat(keywords), itertools.repeat(case_sensitive)):
+                writer.write(matched)
+    finally:
+        writer.close()
+        writer.wait()
+    return start_line
+
+SEARCH_SKIP = ('.idx', '.gzi', '.clock', '.csv', '.json', '.db', '.db-wal', '.db-shm')  # 日志目录中不参与搜索的附属文件
+
+def search_range(path, start, end, keywords, case_sensitive, limit=2000):
+    """进程池工作函数：扫描文件中起始于[start, end)的行，返回(换行数, [(段内行号, 行)], 是否截断)
+
+    普通文件用mmap按块交给LineFilter.scan，不逐行解码；.gz只能整文件流式解压扫描。
+    """
+    flt = LineFilter(keywords, case_sensitive)
+    matches = []
+    newlines = 0
+    truncated = False
+
+    def scan(block):
+        # 超过上限后不再收集结果，但仍要数完换行，后续段的行号才正确
+        nonlocal newlines, truncated
+        if truncated:
+            newlines += block.count(b'\n')
+            return
+        last = 0
+        for offset, line in flt.scan(block):
+            newlines += block.count(b'\n', last, offset)
+            last = offset
+            if len(matches) >= limit:
+                truncated = True
+                break
+            matches.append((newlines, line.decode('utf-8', errors='replace').rstrip('\r\n')))
+        newlines += block.count(b'\n', last)
+
+    if path.endswith('.gz'):
+        tail = b''
+        with gzip.open(path, 'rb') as f:
+            for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                block = tail + block
+                cut = block.rfind(b'\n') + 1
+                tail = block[cut:]
+                scan(block[:cut])
+        scan(tail)
+        return newlines, matches, truncated
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0, [], False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # 边界对齐到行首：每行归属于它起始位置所在的范围
+            if start > 0 and mm[start - 1:start] != b'\n':
+                start = mm.find(b'\n', start) + 1 or size
+            end = min(end, size)
+            if end < size and mm[end - 1:end] != b'\n':
+                end = mm.find(b'\n', end) + 1 or size
+            block_size = 8 * 1024 * 1024
+            pos = start
+            while pos < end:
+                stop = min(pos + block_size, end)
+                if stop < end:
+                    stop = mm.rfind(b'\n', pos, stop) + 1 or mm.find(b'\n', stop) + 1 or end
+                scan(mm[pos:stop])
+                pos = stop
+    return newlines, matches, truncated
+
+def search_archives(paths, keywords, case_sensitive, workers=None, chunk_size=64 * 1024 * 1024):
+    """在多个日志文件中并行查找关键词，按文件和行号顺序逐条产出(文件, 行号, 行)
+
+    大文件按chunk_size切成多段分给进程池，各段的换行数按顺序累加得到行号（从1开始）；
+    某段匹配过多被截断时产出(文件, None, 提示)。
+    """
+    tasks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if path.endswith('.gz') or size <= chunk_size:
+            tasks.append((path, 0, size))
+        else:
+            tasks.extend((path, start, start + chunk_size) for start in range(0, size, chunk_size))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(search_range, *zip(*tasks), itertools.repeat(keywords),
+                           itertools.repeat(case_sensitive)) if tasks else []
+        current, base = None, 0
+        try:
+            for (path, start, end), (newlines, matches, truncated) in zip(tasks, results):
+                if path != current:
+                    current, base = path, 0
+                for line_no, text in matches:
+                    yield path, base + line_no + 1, text
+                if truncated:
+                    yield path, None, "…… 匹配过多，这一段其余的结果已省略"
+                base += newlines
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+class SharedRing:
+    """共享内存环形缓冲：分成固定大小的槽，上游把读到的块写进空闲槽，过滤进程按名字直接读取
+
+    块本身不经过进程间管道复制，管道中只传槽的位置和长度；空闲槽用asyncio队列管理，
+    槽用完时上游等待最早的一批结果，形成背压。
+    """
+    def __init__(self, slots=16, slot_size=1024 * 1024):
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self.name = self.shm.name
+        self.free = asyncio.Queue()
+        for slot in range(slots):
+            self.free.put_nowait(slot)
+
+    def write(self, slot, block):
+        offset = slot * self.slot_size
+        self.shm.buf[offset:offset + len(block)] = block
+        return offset
+
+    def close(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+_worker_rings = {}    # 过滤进程中打开的共享内存，只保留最近使用的一个
+_worker_filters = {}  # 过滤进程中已编译的过滤器，按(关键词, 区分大小写)缓存
+
+def attach_ring(name):
+    shm = _worker_rings.get(name)
+    if shm is None:
+        # 先关闭其他环的映射：上游关闭的环已被删除，映射不关闭的话其16MB内存会一直留在进程中；
+        # 多个抓取同时使用时只是重新映射一次，开销很小
+        for old in _worker_rings.values():
+            old.close()
+        _worker_rings.clear()
+        # 进程池的子进程与上游共用同一个资源跟踪器，重复登记无害，由上游负责删除
+        shm = _worker_rings[name] = shared_memory.SharedMemory(name=name)
+    return shm
+
+def filter_ring_slot(ring_name, offset, length, specs):
+    """进程池工作函数：用各订阅者的过滤器扫描共享内存中的一块，返回(行数, {(关键词, 区分大小写): 匹配行})"""
+    block = bytes(attach_ring(ring_name).buf[offset:offset + length])
+    results = {}
+    for spec in specs:
+        flt = _worker_filters.get(spec)
+        if flt is None:
+            if len(_worker_filters) >= 64:
+                _worker_filters.clear()  # 关键词切换很多次后重新编译即可
+            flt = _worker_filters[spec] = LineFilter(*spec)
+        results[spec] = flt.filter_block(None, block) if not flt.match_all else LogSource.split_block(block)
+    return block.count(b'\n'), results
+
+class LogSource:
+    """一个(设备, 日志类型)对应一个上游进程，读取后逐块分发给所有订阅者"""
+    COMMANDS = {
+        'logcat': ['shell', 'logcat'],
+        # /dev/kmsg不可读（权限受限）时退回dmesg -w；两种输出都由KmsgSource解析
+        'kmsg': ['shell', 'cat /dev/kmsg 2>/dev/null || dmesg -r -w'],
+        'qsee_log': ['shell', 'cat', '/proc/tzdbg/qsee_log'],
+    }
+
+    def __init__(self, log_type, serial=None, on_exit=None, retain_lines=50000, pool=None, on_pool_broken=None):
+        self.log_type = log_type
+        self.serial = serial
+        self.key = (serial, log_type)
+        self.on_exit = on_exit
+        self.on_pool_broken = on_pool_broken  # 进程池不可用时通知其所有者，参数为该进程池
+        self.subscribers = {}
+        self.retain_lines = retain_lines
+        self.recent = collections.deque(maxlen=retain_lines)  # 最近的原始行，切换关键词时回放
+        # 多进程过滤：读到的块放进共享内存环，由进程池过滤，结果按读取顺序交给订阅者
+        self.pool = pool
+        self.ring = None
+        self.in_flight = collections.deque()  # (future, 槽, 块, 字节数, {窗口: 过滤器规格})
+        self.consumer = None
+        self.recent_blocks = collections.deque(maxlen=8)  # 多进程模式下最近的原始块
+        self.raw_writer = None  # 原始日志写盘线程，由需要保存原始日志的订阅者开启
+        self.proc = None
+        self.stopping = False
+        # 断线续传：记录最后一行logcat的时间，以及该时间下已收到的行，重连后用于去重
+        self.last_stamp = None
+        self.last_stamp_lines = set()
+        self.resuming = False
+        self.lost_at = None
+
+    def adb(self):
+        return ['adb'] + (['-s', self.serial] if self.serial else [])
+
+    def command(self):
+        cmd = self.adb() + self.COMMANDS[self.log_type]
+        if self.resuming and self.log_type == 'logcat' and self.last_stamp:
+            # 从最后收到的时间点继续，该时间点的行会重复，由skip_replayed去掉
+            cmd += ['-T', f"'{self.last_stamp}'"]
+        return cmd
+
+    # 以下方法只在读取循环线程中调用，订阅者可随时挂载/卸载而无需重启上游
+    def subscribe(self, session):
+        session.source = self
+        self.subscribers[session.window_id] = session
+        raw_path = getattr(session, 'raw_path', None)
+        if raw_path and self.raw_writer is None:
+            try:
+                # 原始日志量大，用较小的分段尽快轮转压缩
+                self.raw_writer = LogWriter(raw_path, max_bytes=32 * 1024 * 1024, compress=True)
+                self.raw_writer.on_error = self.notify_all
+            except OSError as e:
+                session.notify(f"无法保存原始日志：{str(e)}")
+
+    def notify_all(self, text):
+        for session in list(self.subscribers.values()):
+            session.notify(text)
+
+    def unsubscribe(self, window_id):
+        session = self.subscribers.pop(window_id, None)
+        if session is not None:
+            session.close()
+        if not self.subscribers:
+            self.stop()
+
+    def stop(self):
+        self.stopping = True
+        if self.proc is not None and self.proc.returncode is None:
+            try:
+                self.proc.terminate()
+            except ProcessLookupError:
+                pass
+
+    def track_position(self, lines):
+        """记录最后一个logcat时间戳以及该时间戳下的行"""
+        stamp = None
+        for line in reversed(lines):
+            if not DeviceClock.LOGCAT_TIME.match(line):
+                continue
+            if stamp is None:
+                stamp = line[:18]
+                if stamp != self.last_stamp:
+                    self.last_stamp = stamp
+                    self.last_stamp_lines = set()
+            elif line[:18] != stamp:
+                break
+            self.last_stamp_lines.add(line)
+
+    def skip_replayed(self, lines):
+        """重连后logcat -T会重发最后时间点及之前的行，跳过已收到的部分"""
+        for i, line in enumerate(lines):
+            if not DeviceClock.LOGCAT_TIME.match(line):
+                continue
+            stamp = line[:18]
+            if stamp < self.last_stamp or (stamp == self.last_stamp and line in self.last_stamp_lines):
+                continue
+            self.resuming = False
+            return lines[i:]
+        return []
+
+    @staticmethod
+    def normalize_block(block):
+        """去掉行尾的\\r；整块过滤和切分都在处理后的字节上进行"""
+        return block.replace(b'\r\n', b'\n') if b'\r' in block else block
+
+    @staticmethod
+    def split_block(block):
+        """把以换行结尾的一块字节整体解码并切成行，每行保留换行符"""
+        parts = block.decode('utf-8', errors='replace').split('\n')
+        parts.pop()
+        return [part + '\n' for part in parts]
+
+    def recent_lines(self):
+        """最近保留的原始行（多进程模式下保留的是原始块，取用时才解码）"""
+        lines = []
+        for block in self.recent_blocks:
+            lines.extend(self.split_block(block))
+        lines.extend(self.recent)
+        return lines[-self.retain_lines:]
+
+    def dispatch(self, lines, nbytes=0, block=None):
+        """把一批行交给所有订阅者；block为同一批行的原始字节，订阅者可以整块过滤"""
+        if self.resuming and self.log_type == 'logcat' and self.last_stamp:
+            skipped = self.skip_replayed(lines)
+            if not skipped:
+                return
+            if len(skipped) != len(lines):
+                block = None  # 去掉了重发的前缀，字节块不再与行对应
+            lines = skipped
+        self.resuming = False
+        self.check_reconnected()
+        if self.log_type == 'logcat':
+            self.track_position(lines)
+        self.recent.extend(lines)
+        if self.raw_writer is not None:
+            self.raw_writer.write(lines, time.time())
+        for session in list(self.subscribers.values()):
+            session.feed(lines, nbytes, block)
+
+    def check_reconnected(self):
+        if self.lost_at is not None:
+            # 重连后收到第一批数据，记录重连耗时
+            latency = time.time() - self.lost_at
+            self.lost_at = None
+            for session in self.subscribers.values():
+                session.stats.reconnects += 1
+                session.stats.reconnect_latency = latency
+                session.mark(f"设备已重连，日志中断 {latency:.1f} 秒")
+
+    async def submit(self, block, nbytes):
+        """多进程模式：把块写进共享内存环交给进程池过滤，结果由consume按顺序分发"""
+        if self.ring is None:
+            self.ring = SharedRing()
+        if self.resuming or len(block) > self.ring.slot_size:
+            # 断线续传要逐行去重，超大块放不进槽，都在本进程处理；先等前面的结果分发完保持顺序
+            await self.wait_in_flight()
+            self.dispatch(self.split_block(block), nbytes, block)
+            return
+        slot = await self.ring.free.get()
+        offset = self.ring.write(slot, block)
+        # 需要全部行的订阅者（触发式、速率检测、时间线）仍在本进程过滤
+        specs = {window_id: (session.filter.text, session.filter.case_sensitive)
+                 for window_id, session in self.subscribers.items() if not session.needs_all_lines()}
+        try:
+            future = asyncio.get_running_loop().run_in_executor(
+                self.pool, filter_ring_slot, self.ring.name, offset, len(block), sorted(set(specs.values())))
+        except (concurrent.futures.BrokenExecutor, RuntimeError) as e:
+            # 进程池中有进程异常退出（或已关闭）时提交会直接抛出；之后都在本进程过滤
+            self.ring.free.put_nowait(slot)
+            pool, self.pool = self.pool, None
+            if self.on_pool_broken:
+                self.on_pool_broken(pool)
+            self.notify_all(f"过滤进程池不可用，改为本进程过滤: {str(e)}")
+            await self.wait_in_flight()
+            self.dispatch(self.split_block(block), nbytes, block)
+            return
+        self.in_flight.append((future, slot, block, nbytes, specs))
+        if self.consumer is None or self.consumer.done():
+            self.consumer = asyncio.ensure_future(self.consume())
+
+    async def consume(self):
+        while self.in_flight:
+            future, slot, block, nbytes, specs = self.in_flight[0]
+            try:
+                nlines, results = await future
+            except Exception as e:
+                print(f"过滤进程出错，改为本进程过滤: {str(e)}")
+                nlines, results = block.count(b'\n'), {}
+            self.in_flight.popleft()
+            self.ring.free.put_nowait(slot)
+            self.dispatch_filtered(block, nbytes, specs, nlines, results)
+
+    async def wait_in_flight(self):
+        if self.consumer is not None and not self.consumer.done():
+            await self.consumer
+
+    def dispatch_filtered(self, block, nbytes, specs, nlines, results):
+        """按读取顺序分发进程池的过滤结果；只在确实需要时才在本进程解码整块"""
+        self.check_reconnected()
+        if self.log_type == 'logcat':
+            # 断线续传只需要块末尾同一时间戳的行
+            tail = block.rfind(b'\n', 0, max(len(block) - 8192, 0)) + 1
+            self.track_position(self.split_block(block[tail:]))
+        self.recent_blocks.append(block)
+        if self.raw_writer is not None:
+            self.raw_writer.write_block(block, time.time())
+        lines = None
+        for window_id, session in list(self.subscribers.items()):
+            spec = specs.get(window_id)
+            # 提交后切换过关键词的订阅者不能用旧结果
+            if spec in results and spec == (session.filter.text, session.filter.case_sensitive):
+                session.feed_matched(nlines, results[spec], nbytes)
+            else:
+                if lines is None:
+                    lines = self.split_block(block)
+                session.feed(lines, nbytes, block)
+
+    async def stream(self):
+        """运行一次上游进程，直到其退出或被终止"""
+        self.proc = await asyncio.create_subprocess_exec(*self.command(),
+                                                         stdout=subprocess.PIPE,
+                                                         stderr=subprocess.DEVNULL)
+        if self.stopping:
+            self.stop()
+        pending = b''
+        read_size = 512 * 1024 if self.pool is not None else 65536
+        
+        while True:
+            # 按块读取，无数据时挂起等待而不是轮询
+            chunk = await self.proc.stdout.read(read_size)
+            if not chunk:
+                break  # EOF：进程已退出或被终止
+            
+            block = pending + chunk
+            cut = block.rfind(b'\n') + 1
+            pending = block[cut:]  # 末尾不完整的行留到下一块
+            if not cut:
+                continue
+            # 整块只解码一次、切分一次，由所有订阅者共享；过滤也按整块进行
+            block = self.normalize_block(block[:cut])
+            if self.pool is not None:
+                await self.submit(block, len(chunk))
+            else:
+                self.dispatch(self.split_block(block), len(chunk), block)
+        
+        await self.wait_in_flight()
+        if pending:
+            self.dispatch(self.split_block(self.normalize_block(pending + b'\n')), 0)
+        await self.proc.wait()
+
+    async def device_lost(self):
+        """上游退出后确认是否因设备断开（重启、拔线）；设备仍在线说明是正常结束"""
+        await asyncio.sleep(1)
+        proc = await asyncio.create_subprocess_exec(*self.adb(), 'get-state',
+                                                    stdout=subprocess.PIPE,
+                                                    stderr=subprocess.DEVNULL)
+        output, _ = await proc.communicate()
+        return output.decode(errors='replace').strip() != 'device'
+
+    async def wait_for_device(self):
+        self.proc = await asyncio.create_subprocess_exec(*self.adb(), 'wait-for-device',
+                                                         stdout=subprocess.DEVNULL,
+                                                         stderr=subprocess.DEVNULL)
+        if self.stopping:
+            self.stop()
+        await self.proc.wait()
+
+    async def run(self):
+        try:
+            while True:
+                await self.stream()
+                ended_at = time.time()
+                if self.stopping or not self.subscribers or not await self.device_lost():
+                    break
+                # 设备断开：保持窗口和文件，等待设备回来后从断点继续
+                self.lost_at = ended_at
+                for session in list(self.subscribers.values()):
+                    session.mark("设备断开，等待重新连接")
+                await self.wait_for_device()
+                if self.stopping or not self.subscribers:
+                    break
+                self.resuming = True
+                
+        except Exception as e:
+            for session in self.subscribers.values():
+                session.notify(f"Error: {str(e)}")
+        finally:
+            self.stop()
+            if self.proc is not None:
+                await self.proc.wait()
+            self.shutdown()
+
+    def shutdown(self):
+        """关闭所有订阅者和原始日志写盘线程"""
+        if self.consumer is not None:
+            self.consumer.cancel()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        for session in list(self.subscribers.values()):
+            session.close()
+        self.subscribers.clear()
+        if self.raw_writer is not None:
+            self.raw_writer.close()
+        if self.on_exit:
+            self.on_exit(self)
+
+class KmsgSource(LogSource):
+    """结构化内核日志：读取/dev/kmsg记录（先转储缓冲区再持续跟随），无权限时退回dmesg -w
+
+    与/proc/kmsg不同，/dev/kmsg的读取不会取走记录，可与其他读者共存。记录的级别、序列号、
+    单调时间和消息被解析后改写为统一的“<级别>[单调时间] 设备本地时间 消息”行；按序列号
+    （dmesg输出没有序列号时按单调时间）去掉断线重连后重复转储的记录，序列号跳跃说明缓冲区
+    已被覆盖，会写入标记行。设备本地时间由开机时刻换算，设备休眠过时会偏早。
+    """
+    RECORD = re.compile(rb'^(\d+),(\d+),(\d+),[^;]*;')
+    DMESG = re.compile(rb'^<(\d+)>\[\s*(\d+)\.(\d+)\]\s?')
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.clock = None
+        self.last_seq = None
+        self.last_usec = -1
+        self.last_usec_texts = set()  # 最后一个单调时间下已收到的消息，dmesg输出去重用
+
+    async def stream(self):
+        clock = await asyncio.get_running_loop().run_in_executor(None, DeviceClock.query, self.serial)
+        if self.clock is not None and self.clock.boot_local is not None and clock.boot_local is not None \
+                and abs(clock.boot_local - self.clock.boot_local) > 5:
+            # 设备重启过，序列号和单调时间都从头开始
+            self.last_seq = None
+            self.last_usec = -1
+            self.last_usec_texts = set()
+        self.clock = clock
+        await super().stream()
+
+    @classmethod
+    def parse_record(cls, raw):
+        """解析一条/dev/kmsg记录或dmesg -r行，返回(级别, 序列号, 单调时间微秒, 消息)，无法解析时返回None"""
+        m = cls.RECORD.match(raw)
+        if m:
+            pri, seq, usec = map(int, m.groups())
+            return pri & 7, seq, usec, raw[m.end():]
+        m = cls.DMESG.match(raw)
+        if m:
+            usec = int(m.group(2)) * 1000000 + int(m.group(3)[:6].ljust(6, b'0'))
+            return int(m.group(1)) & 7, None, usec, raw[m.end():]
+        return None
+
+    def accept(self, seq, usec, text):
+        """判断记录是否是新的；发现序列号跳跃时写入标记行"""
+        if seq is not None and self.last_seq is not None:
+            if seq <= self.last_seq:
+                return False
+            if seq > self.last_seq + 1:
+                for session in list(self.subscribers.values()):
+                    session.mark(f"内核日志缓冲区已被覆盖，丢失 {seq - self.last_seq - 1} 条记录")
+        elif seq is None and (usec < self.last_usec or (usec == self.last_usec and text in self.last_usec_texts)):
+            return False
+        if seq is not None:
+            self.last_seq = seq
+        if usec != self.last_usec:
+            self.last_usec = usec
+            self.last_usec_texts = set()
+        self.last_usec_texts.add(text)
+        return True
+
+    def normalize_block(self, block):
+        """把一块记录改写为统一格式的行，去掉重复转储的记录和/dev/kmsg的键值续行"""
+        boot = self.clock.boot_local if self.clock is not None else None
+        out = []
+        for raw in block.split(b'\n')[:-1]:
+            raw = raw.rstrip(b'\r')
+            if not raw or raw.startswith(b' '):
+                continue  # SUBSYSTEM=、DEVICE=等续行
+            record = self.parse_record(raw)
+            if record is None:
+                out.append(raw + b'\n')  # 出错信息等原样保留
+                continue
+            level, seq, usec, text = record
+            if not self.accept(seq, usec, text):
+                continue
+            wall = b'' if boot is None else DeviceClock.format(boot + usec / 1e6).encode() + b' '
+            out.append(b'<%d>[%5d.%06d] %s%s\n' % (level, usec // 1000000, usec % 1000000, wall, text))
+        return b''.join(out)
+
+class ReplaySource(LogSource):
+    """把已保存的日志会话按原速、倍速或尽快送入与实时抓取相同的管道，用于离线调试过滤和测吞吐
+
+    speed为0时不等待，只在每块之间让出事件循环；按时间回放时超过max_gap秒的空档会被压缩。
+    """
+    def __init__(self, path, speed=1.0, max_gap=5.0, on_exit=None):
+        super().__init__('replay', on_exit=on_exit)
+        self.path = path
+        self.key = ('replay', path, id(self))
+        self.speed = speed
+        self.max_gap = max_gap
+        self.clock = DeviceClock(boot_local=0.0)  # 内核日志直接按单调时间计
+        self.replayed = 0
+
+    async def stream(self):
+        last_ts = None
+        target = time.monotonic()  # 下一行按录制时间应送出的时刻
+        for segment in SegmentIndex.segment_files(self.path):
+            with SegmentIndex.open_segment(segment) as f:
+                pending = b''
+                while not self.stopping:
+                    chunk = f.read(256 * 1024)
+                    if not chunk:
+                        break
+                    block = pending + chunk
+                    cut = block.rfind(b'\n') + 1
+                    pending = block[cut:]
+                    block = self.normalize_block(block[:cut])
+                    batch = self.split_block(block)
+                    if not self.speed:
+                        self.send(batch, len(chunk), block)
+                        await asyncio.sleep(0)
+                        continue
+                    # 按行时间切成小批，每批送出前等到其录制时刻
+                    start = 0
+                    for i, line in enumerate(batch):
+                        ts = self.clock.parse(line)[0]
+                        if ts is None:
+                            continue
+                        if last_ts is not None:
+                            target += min(max(ts - last_ts, 0.0), self.max_gap) / self.speed
+                        last_ts = ts
+                        delay = target - time.monotonic()
+                        if delay > 0.005:
+                            self.send(batch[start:i])
+                            start = i
+                            await asyncio.sleep(delay)
+                            if self.stopping:
+                                return
+                    self.send(batch[start:], len(chunk))
+                if pending and not self.stopping:
+                    self.send(self.split_block(self.normalize_block(pending + b'\n')))
+
+    def send(self, lines, nbytes=0, block=None):
+        if lines:
+            self.replayed += len(lines)
+            self.dispatch(lines, nbytes, block)
+
+    async def run(self):
+        started = time.monotonic()
+        try:
+            await self.stream()
+            elapsed = max(time.monotonic() - started, 1e-6)
+            for session in list(self.subscribers.values()):
+                session.mark(f"回放结束：{self.replayed} 行，用时 {elapsed:.2f} 秒，"
+                             f"{self.replayed / elapsed:.0f} 行/秒")
+        except Exception as e:
+            for session in self.subscribers.values():
+                session.notify(f"Error: {str(e)}")
+        finally:
+            self.stopping = True
+            self.shutdown()
+
+class LogView(ttk.Frame):
+    """虚拟化日志视图：内存中只保留固定行数的环形缓冲，只渲染可见的一屏
+
+    行号与磁盘上的全局行号一致，开启"翻阅磁盘历史"后可滚动到环形缓冲之前，
+    更早的内容通过SegmentIndex从日志分段按需读取。
+    """
+    KEYWORD_COLORS = ['#d00000', '#0050d0', '#008000', '#b000b0', '#c06000', '#008080']
+
+    def __init__(self, parent, path=None, start_line=0, capacity=20000):
+        super().__init__(parent)
+        self.lines = collections.deque(maxlen=capacity)
+        self.numbers = collections.deque(maxlen=capacity)  # 每行对应的磁盘行号
+        self.spans = collections.deque(maxlen=capacity)    # 每行的关键词位置，来自过滤阶段
+        self.path = path
+        self.index = None
+        self.index_total = 0  # 上次加载索引时的总行数
+        self.start_line = start_line
+        self.top = start_line    # 可见区域第一行的位置
+        self.rows = 20
+        self.follow = True
+        self.page_cache = (0, [])
+        self.history_enabled = tk.BooleanVar(value=False)
+
+        self.text = tk.Text(self, wrap=tk.NONE)
+        self.vsb = ttk.Scrollbar(self, orient="vertical", command=self.yview)
+        hsb = ttk.Scrollbar(self, orient="horizontal", command=self.text.xview)
+        self.text.configure(xscrollcommand=hsb.set)
+        self.text.grid(row=0, column=0, sticky="nsew")
+        self.vsb.grid(row=0, column=1, sticky="ns")
+        hsb.grid(row=1, column=0, sticky="ew")
+        self.rowconfigure(0, weight=1)
+        self.columnconfigure(0, weight=1)
+
+        self.linespace = tkfont.Font(font=self.text['font']).metrics('linespace')
+        self.text.bind('<Configure>', self.on_resize)
+        self.text.bind('<MouseWheel>', lambda e: self.scroll(-3 if e.delta > 0 else 3))
+        self.text.bind('<Button-4>', lambda e: self.scroll(-3))
+        self.text.bind('<Button-5>', lambda e: self.scroll(3))
+
+        # 查找：按时间片在环形缓冲和磁盘分段中查找，每片之间让出Tk事件循环
+        self.find_text = ''
+        self.find_case = False
+        self.find_pos = None   # 当前命中行的位置
+        self.find_gen = 0      # 每次新查找或取消时递增，旧的时间片看到后自行退出
+        self.text.tag_configure('find', background='yellow')
+        self.text.tag_configure('find_current', background='#ffd27f')
+        self.bold_font = tkfont.Font(font=self.text['font'], weight='bold')
+        for k, color in enumerate(self.KEYWORD_COLORS):
+            self.text.tag_configure(f'kw{k}', foreground=color, font=self.bold_font)
+
+    @property
+    def base(self):
+        """环形缓冲第一行的位置；其之前的位置即磁盘行号"""
+        return self.numbers[0] if self.numbers else self.start_line
+
+    @property
+    def total(self):
+        return self.base + len(self.lines)
+
+    def lowest(self):
+        """可翻阅的最早位置"""
+        if self.history_enabled.get() and self.path:
+            return 0
+        return self.base
+
+    def append(self, numbers, lines, spans=None):
+        """追加一批行并重绘一次；旧行自动从环形缓冲中淘汰"""
+        if not lines:
+            return
+        self.lines.extend(lines)
+        self.numbers.extend(numbers)
+        self.spans.extend(spans or itertools.repeat(None, len(lines)))
+        if self.follow:
+            self.top = max(self.lowest(), self.total - self.rows)
+        self.render()
+
+    def get_lines(self, start, count):
+        base = self.base
+        result = []
+        if start < base:
+            result = self.read_history(start, min(count, base - start))
+            count -= len(result)
+            start = base
+        if count > 0:
+            result.extend(itertools.islice(self.lines, start - base, start - base + count))
+        return result
+
+    def get_spans(self, start, count):
+        """可见行的关键词位置；磁盘历史中的行没有位置信息"""
+        base = self.base
+        skip = min(max(base - start, 0), count)
+        result = [None] * skip
+        first = start + skip - base
+        result.extend(itertools.islice(self.spans, first, first + count - skip))
+        return result
+
+    def read_history(self, start, count):
+        """从磁盘分段读取环形缓冲之前的行，按页缓存"""
+        cache_start, cache = self.page_cache
+        if not (cache_start <= start and start + count <= cache_start + len(cache)):
+            if self.index is None:
+                self.index = SegmentIndex(self.path)
+                self.index_total = self.total
+            elif self.index_total != self.total:
+                # 有新行写入（可能发生了轮转）才重新列出分段
+                self.index.reload()
+                self.index_total = self.total
+            page_start = max(0, start - 200)
+            cache = self.index.read_lines(page_start, count + 400)
+            self.page_cache = (page_start, cache)
+            cache_start = page_start
+        return cache[start - cache_start:start - cache_start + count]
+
+    def render(self):
+        visible = self.get_lines(self.top, self.rows)
+        self.text.delete('1.0', tk.END)
+        self.text.insert('1.0', ''.join(visible).rstrip('\n'))
+        self.highlight_keywords()
+        if self.find_text:
+            self.highlight_find()
+        span = max(self.total - self.lowest(), 1)
+        first = (self.top - self.lowest()) / span
+        self.vsb.set(first, min(first + self.rows / span, 1.0))
+
+    def scroll_to(self, top):
+        bottom = max(self.lowest(), self.total - self.rows)
+        self.top = min(max(int(top), self.lowest()), bottom)
+        self.follow = self.top >= bottom
+        self.render()
+
+    def scroll(self, amount):
+        self.scroll_to(self.top + amount)
+
+    def highlight_keywords(self):
+        """按过滤器给出的位置给可见行的关键词上色，每种颜色只调用一次tag_add"""
+        ranges = collections.defaultdict(list)
+        colors = len(self.KEYWORD_COLORS)
+        for row, spans in enumerate(self.get_spans(self.top, self.rows), 1):
+            if spans:
+                for start, end, k in spans:
+                    ranges[k % colors].extend((f"{row}.{start}", f"{row}.{end}"))
+        for k, indexes in ranges.items():
+            self.text.tag_add(f'kw{k}', *indexes)
+
+    def highlight_find(self):
+        """只在可见的一屏中标出查找词，当前命中行整行标出"""
+        if self.find_pos is not None and 0 <= self.find_pos - self.top < self.rows:
+            row = self.find_pos - self.top + 1
+            self.text.tag_add('find_current', f"{row}.0", f"{row}.end")
+        count = tk.IntVar()
+        index = '1.0'
+        while True:
+            index = self.text.search(self.find_text, index, stopindex=tk.END, count=count,
+                                     nocase=not self.find_case)
+            if not index or not count.get():
+                break
+            end = f"{index}+{count.get()}c"
+            self.text.tag_add('find', index, end)
+            index = end
+
+    def find(self, text, forward=True, case=False, restart=False, on_progress=None, on_done=None):
+        """从当前命中（或可见区域）开始查找下一处，到头后从另一端接着找
+
+        先查环形缓冲，再查磁盘上更早的分段；环形缓冲每个时间片最多约15ms，
+        磁盘部分（解压、读分段）放到后台线程，命中后用after交回界面线程，不阻塞界面。
+        restart为True时包含当前行（边输入边查找）。结果通过on_done(位置或None)返回。
+        """
+        self.find_gen += 1
+        gen = self.find_gen
+        self.find_text = text
+        self.find_case = case
+        if not text:
+            self.find_pos = None
+            self.render()
+            if on_done:
+                on_done(None)
+            return
+        needle = text if case else text.lower()
+        if self.find_pos is not None:
+            start = self.find_pos
+        else:
+            start = self.top if forward else self.top + self.rows - 1
+        if restart:
+            start = start - 1 if forward else start + 1
+        first = 0 if self.path else self.base
+        end = self.total
+        # 依次查找的区间：[起点, 终点)，按方向遍历
+        if forward:
+            ranges = [(start + 1, end), (first, min(start + 1, end))]
+        else:
+            ranges = [(first, min(start, end)), (max(start, first), end)]
+        state = {'range': 0, 'pos': None}
+        chunk = 5000
+
+        def search(lines, backward):
+            # 整块拼接后只做一次查找，再数换行得到行内位置，比逐行判断快得多
+            blob = ''.join(lines)
+            if not case:
+                blob = blob.lower()
+            at = blob.rfind(needle) if backward else blob.find(needle)
+            return None if at < 0 else blob.count('\n', 0, at)
+
+        def hit(found):
+            self.find_pos = found
+            if found < self.base:
+                self.history_enabled.set(True)  # 命中在磁盘上，需要能滚动到缓冲之前
+            self.scroll_to(found - self.rows // 3)
+            if on_done:
+                on_done(found)
+
+        def scan_disk(lo, hi):
+            # 后台线程：按块读取[lo, hi)并查找；SegmentIndex另建一份，不与界面线程共用缓存
+            index = self.index if isinstance(self.index, FileLineIndex) else SegmentIndex(self.path)
+            pos = lo if forward else hi
+            found = None
+            while gen == self.find_gen and (pos < hi if forward else pos > lo):
+                count = min(chunk, hi - pos) if forward else min(chunk, pos - lo)
+                start = pos if forward else pos - count
+                lines = index.read_lines(start, count)
+                at = search(lines, not forward)
+                if at is not None:
+                    found = start + at
+                    break
+                pos = (pos + count if lines else hi) if forward else (pos - count if lines else lo)
+                if on_progress:
+                    self.after(0, on_progress, pos)
+            self.after(0, disk_done, found, hi if forward else lo)
+
+        def disk_done(found, end):
+            if gen != self.find_gen:
+                return
+            if found is not None:
+                hit(found)
+                return
+            state['pos'] = end
+            step()
+
+        def step():
+            if gen != self.find_gen:
+                return
+            deadline = time.perf_counter() + 0.015
+            while state['range'] < len(ranges):
+                lo, hi = ranges[state['range']]
+                pos = state['pos']
+                if pos is None:
+                    pos = lo if forward else hi
+                if (forward and pos >= hi) or (not forward and pos <= lo):
+                    state['range'] += 1
+                    state['pos'] = None
+                    continue
+                base = self.base
+                if self.path and (pos < base if forward else pos <= base):
+                    # 磁盘上的部分交给后台线程，完成后由disk_done接着查找
+                    disk_lo, disk_hi = (pos, min(hi, base)) if forward else (lo, pos)
+                    threading.Thread(target=scan_disk, args=(disk_lo, disk_hi), name="LogFind",
+                                     daemon=True).start()
+                    return
+                if forward:
+                    count = min(chunk, hi - pos)
+                    lines = self.get_lines(pos, count)
+                    found = search(lines, False)
+                    state['pos'] = pos + count if lines else hi
+                    found = None if found is None else pos + found
+                else:
+                    count = min(chunk, pos - max(lo, base if self.path else lo))
+                    lines = self.get_lines(pos - count, count)
+                    found = search(lines, True)
+                    state['pos'] = pos - count if lines else lo
+                    found = None if found is None else pos - count + found
+                if found is not None:
+                    hit(found)
+                    return
+                if time.perf_counter() >= deadline:
+                    if on_progress:
+                        on_progress(state['pos'])
+                    self.after(1, step)
+                    return
+            self.find_pos = None
+            self.render()
+            if on_done:
+                on_done(None)
+
+        step()
+
+    def cancel_find(self, clear=False):
+        self.find_gen += 1
+        if clear:
+            self.find_text = ''
+            self.find_pos = None
+            self.render()
+
+    def yview(self, *args):
+        if args[0] == 'moveto':
+            self.scroll_to(self.lowest() + float(args[1]) * (self.total - self.lowest()))
+        elif args[0] == 'scroll':
+            step = self.rows if args[2] == 'pages' else 1
+            self.scroll(int(args[1]) * step)
+
+    def on_resize(self, event):
+        self.rows = max(1, event.height // self.linespace)
+        self.scroll_to(self.total if self.follow else self.top)
+
 class LogTools(ttk.Frame):
+    DEFAULT_DEVICE = "默认设备"
+    ALL_DEVICES = "全部设备"
+
     def __init__(self, parent, controller):
         super().__init__(parent)
         self.controller = controller
@@ -907,10 +3691,14 @@ class LogTools(ttk.Frame):
         os.makedirs(self.default_dir, exist_ok=True)
         self.create_header()
         self.create_widgets()
-        self.queues = {}
+        self.channels = {}
         self.log_windows = {}
-        self.processes = {}
+        self.sessions = {}
+        self.sources = {}  # (设备, 日志类型) -> LogSource，仅在读取循环线程中访问
+        self.filter_pool = None  # 多进程过滤共用的进程池，按需创建，只在读取循环线程中访问
+        self.filter_workers = 0
         self.running_flags = {}  # 新增运行状态标志
+        self.capture_loop = CaptureLoop()  # 所有窗口共用一个读取线程
 
     def create_header(self):
         """创建标题和返回按钮"""
@@ -992,6 +3780,16 @@ class LogTools(ttk.Frame):
         self.kmsg_path.grid(row=3, column=1, padx=5, sticky="ew")
         ttk.Button(self.kmsg_frame, text="浏览", command=lambda: self.browse('kmsg')).grid(row=3, column=2, padx=5)
 
+        # 级别和驱动前缀过滤在关键词之前进行
+        ttk.Label(self.kmsg_frame, text="最低严重级别:").grid(row=4, column=0, padx=5, sticky="w")
+        self.kmsg_level = ttk.Combobox(self.kmsg_frame, values=KmsgFilter.LEVELS, width=12, state="readonly")
+        self.kmsg_level.set(KmsgFilter.LEVELS[-1])
+        self.kmsg_level.grid(row=4, column=1, padx=5, sticky="w")
+
+        ttk.Label(self.kmsg_frame, text="驱动前缀（逗号分隔）:").grid(row=5, column=0, padx=5, sticky="w")
+        self.kmsg_prefixes = ttk.Entry(self.kmsg_frame, width=30)
+        self.kmsg_prefixes.grid(row=5, column=1, padx=5, sticky="ew")
+
         # qsee_log配置
         self.qsee_log_frame = ttk.LabelFrame(self, text="qsee_log配置")
         self.qsee_log_frame.grid(row=3, column=0, padx=10, pady=5, sticky="ew")
@@ -1021,25 +3819,121 @@ class LogTools(ttk.Frame):
         ttk.Button(self.qsee_log_frame, text="浏览", command=lambda: self.browse('qsee_log')).grid(row=3, column=2, padx=5)
 
 
+        # 存储选项（分段轮转与压缩）
+        self.storage_frame = ttk.LabelFrame(self, text="存储选项")
+        self.storage_frame.grid(row=4, column=0, padx=10, pady=5, sticky="ew")
+
+        ttk.Label(self.storage_frame, text="分段大小(MB):").grid(row=0, column=0, padx=5, sticky="w")
+        self.segment_size = ttk.Entry(self.storage_frame, width=8)
+        self.segment_size.insert(0, "256")
+        self.segment_size.grid(row=0, column=1, padx=5, sticky="w")
+
+        ttk.Label(self.storage_frame, text="分段时长(分钟):").grid(row=0, column=2, padx=5, sticky="w")
+        self.segment_minutes = ttk.Entry(self.storage_frame, width=8)
+        self.segment_minutes.insert(0, "60")
+        self.segment_minutes.grid(row=0, column=3, padx=5, sticky="w")
+
+        self.compress_segments = tk.BooleanVar(value=True)
+        ttk.Checkbutton(self.storage_frame, text="压缩旧分段(gzip)", variable=self.compress_segments).grid(row=0, column=4, padx=5, sticky="w")
+
+        ttk.Label(self.storage_frame, text="界面积压策略:").grid(row=1, column=0, padx=5, sticky="w")
+        self.backlog_policy = ttk.Combobox(self.storage_frame, values=list(DisplayChannel.POLICIES.values()),
+                                           state="readonly", width=10)
+        self.backlog_policy.current(0)
+        self.backlog_policy.grid(row=1, column=1, columnspan=2, padx=5, sticky="w")
+
+        self.keep_raw = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.storage_frame, text="同时保存原始日志(压缩)", variable=self.keep_raw).grid(row=1, column=3, columnspan=2, padx=5, sticky="w")
+
+        self.build_fts = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.storage_frame, text="建立全文索引", variable=self.build_fts).grid(row=1, column=5, padx=5, sticky="w")
+
+        # 触发式抓取：只保存关键词命中前后的上下文
+        self.trigger_enabled = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.storage_frame, text="触发式抓取", variable=self.trigger_enabled).grid(row=2, column=0, padx=5, sticky="w")
+        trigger_frame = ttk.Frame(self.storage_frame)
+        trigger_frame.grid(row=2, column=1, columnspan=4, sticky="w")
+        self.trigger_entries = {}
+        for col, (name, label, default) in enumerate([('pre_lines', "前置行数", "500"),
+                                                      ('pre_seconds', "前置秒数", "5"),
+                                                      ('post_lines', "后置行数", "500"),
+                                                      ('post_seconds', "后置秒数", "5")]):
+            ttk.Label(trigger_frame, text=label).grid(row=0, column=col * 2, padx=(5, 2))
+            entry = ttk.Entry(trigger_frame, width=6)
+            entry.insert(0, default)
+            entry.grid(row=0, column=col * 2 + 1)
+            self.trigger_entries[name] = entry
+
+        # 刷屏抑制：折叠重复行并按标签限速，文件和界面可分别开启
+        ttk.Label(self.storage_frame, text="刷屏抑制:").grid(row=3, column=0, padx=5, sticky="w")
+        dedup_frame = ttk.Frame(self.storage_frame)
+        dedup_frame.grid(row=3, column=1, columnspan=4, sticky="w")
+        self.dedup_file = tk.BooleanVar(value=False)
+        ttk.Checkbutton(dedup_frame, text="文件", variable=self.dedup_file).grid(row=0, column=0, padx=(5, 2))
+        self.dedup_view = tk.BooleanVar(value=False)
+        ttk.Checkbutton(dedup_frame, text="界面", variable=self.dedup_view).grid(row=0, column=1, padx=(2, 5))
+        self.dedup_entries = {}
+        for col, (name, label, default) in enumerate([('window', "折叠窗口(行)", "8"),
+                                                      ('tag_rate', "单标签限速(行/秒,0不限)", "0")]):
+            ttk.Label(dedup_frame, text=label).grid(row=0, column=2 + col * 2, padx=(5, 2))
+            entry = ttk.Entry(dedup_frame, width=6)
+            entry.insert(0, default)
+            entry.grid(row=0, column=3 + col * 2)
+            self.dedup_entries[name] = entry
+
+        # 速率异常检测：按标签和关键词与基线比较，突增和静默会作为标记行写入
+        self.monitor_enabled = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.storage_frame, text="速率异常检测", variable=self.monitor_enabled).grid(row=4, column=0, padx=5, sticky="w")
+        monitor_frame = ttk.Frame(self.storage_frame)
+        monitor_frame.grid(row=4, column=1, columnspan=4, sticky="w")
+        self.monitor_entries = {}
+        for col, (name, label, default) in enumerate([('spike_factor', "突增倍数", "5"),
+                                                      ('silence', "静默秒数", "10"),
+                                                      ('min_rate', "最低速率(行/秒)", "5")]):
+            ttk.Label(monitor_frame, text=label).grid(row=0, column=col * 2, padx=(5, 2))
+            entry = ttk.Entry(monitor_frame, width=6)
+            entry.insert(0, default)
+            entry.grid(row=0, column=col * 2 + 1)
+            self.monitor_entries[name] = entry
+
+        # 多进程过滤：高吞吐时把关键词匹配分摊到多个进程
+        self.parallel_filter = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.storage_frame, text="多进程过滤", variable=self.parallel_filter).grid(row=5, column=0, padx=5, sticky="w")
+        ttk.Label(self.storage_frame, text="进程数:").grid(row=5, column=1, padx=5, sticky="w")
+        self.filter_workers_entry = ttk.Entry(self.storage_frame, width=6)
+        self.filter_workers_entry.insert(0, str(os.cpu_count() or 2))
+        self.filter_workers_entry.grid(row=5, column=2, padx=5, sticky="w")
+
+        # 本机TCP转发：其他脚本连上即可读取过滤后的实时日志
+        self.stream_enabled = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.storage_frame, text="TCP转发过滤结果", variable=self.stream_enabled).grid(row=5, column=3, padx=5, sticky="w")
+        ttk.Label(self.storage_frame, text="起始端口(0自动):").grid(row=5, column=4, padx=5, sticky="w")
+        self.stream_port = ttk.Entry(self.storage_frame, width=6)
+        self.stream_port.insert(0, "9100")
+        self.stream_port.grid(row=5, column=5, padx=5, sticky="w")
+
         # 控制按钮
-        ttk.Button(self, text="开始抓取", command=self.start).grid(row=4, column=0, pady=10, sticky="ew")
+        control_frame = ttk.Frame(self)
+        control_frame.grid(row=5, column=0, pady=10, sticky="ew")
+        control_frame.columnconfigure(0, weight=1)
 
-    def create_window(self, window_id, log_type, path):
-        window = tk.Toplevel(self)
-        window.title(f"{log_type}日志 - {os.path.basename(path)}")
-        window.geometry("800x400")
-        
-        text_area = scrolledtext.ScrolledText(window, wrap=tk.WORD)
-        text_area.pack(expand=True, fill='both')
-        
-        ttk.Button(window, text="打开文件", command=lambda: os.startfile(path)).pack(pady=5)
-        
-        # 修正1：确保使用UTF-8编码打开文件
-        self.log_windows[window_id] = {
-            'window': window,
-            'text_area': text_area,
-            'file': open(path, 'a', encoding='utf-8', errors='replace')
-        }
+        device_frame = ttk.Frame(control_frame)
+        device_frame.grid(row=0, column=0, columnspan=4, sticky="w", pady=(0, 5))
+        ttk.Label(device_frame, text="设备:").pack(side="left", padx=5)
+        self.device_combo = ttk.Combobox(device_frame, values=[self.DEFAULT_DEVICE, self.ALL_DEVICES],
+                                         state="readonly", width=24)
+        self.device_combo.current(0)
+        self.device_combo.pack(side="left")
+        ttk.Button(device_frame, text="刷新", command=self.refresh_devices).pack(side="left", padx=5)
+
+        ttk.Button(control_frame, text="开始抓取", command=self.start).grid(row=1, column=0, sticky="ew")
+        ttk.Button(control_frame, text="实时合并时间线", command=self.start_timeline).grid(row=1, column=1, padx=5)
+        ttk.Button(control_frame, text="合并已保存日志", command=self.merge_saved).grid(row=1, column=2)
+        ttk.Button(control_frame, text="重新过滤原始日志", command=self.refilter_saved).grid(row=1, column=3, padx=5)
+        ttk.Button(control_frame, text="回放日志", command=self.start_replay).grid(row=1, column=4)
+        ttk.Button(control_frame, text="搜索历史日志", command=self.search_saved).grid(row=1, column=5, padx=5)
+        ttk.Button(control_frame, text="建立全文索引", command=self.build_saved_index).grid(row=2, column=4, pady=(5, 0))
+        ttk.Button(control_frame, text="全文索引查询", command=self.query_saved_index).grid(row=2, column=5, padx=5, pady=(5, 0))
 
     def toggle_history(self, log_type):
         if log_type == 'logcat':
@@ -1085,7 +3979,37 @@ class LogTools(ttk.Frame):
                 self.qsee_log_path.delete(0, tk.END)
                 self.qsee_log_path.insert(0, path)
 
-    def start(self):
+    def list_devices(self):
+        try:
+            result = subprocess.run(["adb", "devices"], capture_output=True, text=True, timeout=3)
+        except Exception as e:
+            print(f"ADB检测异常: {str(e)}")
+            return []
+        return [line.split('\t')[0] for line in result.stdout.splitlines()[1:] if '\tdevice' in line]
+
+    def refresh_devices(self):
+        self.device_combo['values'] = [self.DEFAULT_DEVICE, self.ALL_DEVICES] + self.list_devices()
+
+    def selected_serials(self):
+        """返回要抓取的设备序列号列表；None表示adb默认设备"""
+        choice = self.device_combo.get()
+        if choice == self.ALL_DEVICES:
+            serials = self.list_devices()
+            if not serials:
+                messagebox.showerror("设备未连接", "未检测到安卓设备！")
+                return None
+            return serials
+        if choice == self.DEFAULT_DEVICE or not choice:
+            return [None]
+        return [choice]
+
+    @staticmethod
+    def device_path(path, serial):
+        """多设备同时抓取时，每台设备写入各自的文件"""
+        root, ext = os.path.splitext(path)
+        return f"{root}_{re.sub(r'[^0-9A-Za-z._-]', '_', serial)}{ext}"
+
+    def collect_tasks(self):
         tasks = []
         if self.logcat_enabled.get():
             logcat_keyword = self.logcat_keyword.get().strip()
@@ -1101,146 +4025,761 @@ class LogTools(ttk.Frame):
 
         if not tasks:
             messagebox.showerror("错误", "请至少选择一个日志类型")
+            return None
+        return tasks
+
+    def trigger_options(self):
+        """触发式抓取参数；未启用时返回{}，输入有误时返回None"""
+        if not self.trigger_enabled.get():
+            return {}
+        try:
+            return {
+                'pre_lines': int(self.trigger_entries['pre_lines'].get() or 0),
+                'pre_seconds': float(self.trigger_entries['pre_seconds'].get() or 0),
+                'post_lines': int(self.trigger_entries['post_lines'].get() or 0),
+                'post_seconds': float(self.trigger_entries['post_seconds'].get() or 0),
+            }
+        except ValueError:
+            messagebox.showerror("错误", "触发参数必须是数字")
+            return None
+
+    def dedup_options(self):
+        """刷屏抑制参数；输入有误时返回None"""
+        try:
+            return {
+                'window': int(self.dedup_entries['window'].get() or 1),
+                'tag_rate': int(self.dedup_entries['tag_rate'].get() or 0),
+            }
+        except ValueError:
+            messagebox.showerror("错误", "折叠窗口和限速必须是整数")
+            return None
+
+    def monitor_options(self):
+        """速率异常检测参数；未启用时返回{}，输入有误时返回None"""
+        if not self.monitor_enabled.get():
+            return {}
+        try:
+            return {name: float(entry.get() or 0) for name, entry in self.monitor_entries.items()}
+        except ValueError:
+            messagebox.showerror("错误", "异常检测参数必须是数字")
+            return None
+
+    def kmsg_options(self):
+        """内核日志的级别和驱动前缀过滤；不做限制时返回None"""
+        max_level = KmsgFilter.LEVELS.index(self.kmsg_level.get())
+        prefixes = [p.strip() for p in self.kmsg_prefixes.get().split(',') if p.strip()]
+        if max_level == 7 and not prefixes:
+            return None
+        return KmsgFilter(max_level, prefixes)
+
+    def stream_options(self):
+        """TCP转发参数；未启用时返回{}，输入有误时返回None"""
+        if not self.stream_enabled.get():
+            return {}
+        try:
+            port = int(self.stream_port.get() or 0)
+        except ValueError:
+            port = -1
+        if not 0 <= port <= 65535:
+            messagebox.showerror("错误", "端口必须是0到65535之间的整数")
+            return None
+        return {'port': port}
+
+    def parallel_options(self):
+        """多进程过滤的进程数；未启用时返回0，输入有误时返回None"""
+        if not self.parallel_filter.get():
+            return 0
+        try:
+            workers = int(self.filter_workers_entry.get() or 0)
+        except ValueError:
+            workers = 0
+        if workers < 1:
+            messagebox.showerror("错误", "进程数必须是正整数")
+            return None
+        return workers
+
+    def storage_options(self):
+        try:
+            max_bytes = int(float(self.segment_size.get() or 0) * 1024 * 1024)
+            max_age = int(float(self.segment_minutes.get() or 0) * 60)
+        except ValueError:
+            messagebox.showerror("错误", "分段大小和分段时长必须是数字")
+            return None
+        return max_bytes, max_age
+
+    def remember_keywords(self, keywords):
+        # 历史记录处理（空关键词不保存）
+        if keywords and keywords not in self.keyword_history:
+            self.keyword_history.insert(0, keywords)
+            # 保持历史记录不超过20条
+            if len(self.keyword_history) > 20:
+                self.keyword_history.pop()
+            self.save_history()
+            self.logcat_history['values'] = self.keyword_history
+            self.kmsg_history['values'] = self.keyword_history
+            self.qsee_log_history['values'] = self.keyword_history
+
+    def open_capture(self, title, path, storage, keywords=None, case=False):
+        """创建写盘线程、界面通道和窗口，返回(window_id, writer, channel)"""
+        max_bytes, max_age = storage
+        try:
+            writer = LogWriter(path, max_bytes=max_bytes, max_age=max_age,
+                               compress=self.compress_segments.get(), fts=self.build_fts.get())
+        except OSError as e:
+            messagebox.showerror("错误", f"无法打开日志文件：{str(e)}")
+            return None
+
+        policy = list(DisplayChannel.POLICIES)[self.backlog_policy.current()]
+        channel = DisplayChannel(policy=policy)
+        window_id = str(uuid.uuid4())
+        self.channels[window_id] = channel
+        self.create_window(window_id, title, path, writer.next_line, keywords, case)
+        self.running_flags[window_id] = True  # 新增运行标志
+        return window_id, writer, channel
+
+    def run_session(self, session, replay=None):
+        self.sessions[session.window_id] = session
+        self.capture_loop.call(self.attach, session, replay)
+        self.after(100, self.update_display, session.window_id)
+
+    def start(self):
+        tasks = self.collect_tasks()
+        storage = self.storage_options()
+        trigger = self.trigger_options()
+        dedup = self.dedup_options()
+        monitor = self.monitor_options()
+        stream = self.stream_options()
+        workers = self.parallel_options()
+        if tasks is None or storage is None or trigger is None or dedup is None or monitor is None \
+                or stream is None or workers is None:
+            return
+        serials = self.selected_serials()
+        if serials is None:
             return
     
-        for task in tasks:
+        for task, serial in itertools.product(tasks, serials):
             log_type, keywords, path, case = task
             # 修改验证逻辑（仅检查路径）
             if not path:  # 移除了对keywords的检查
                 messagebox.showerror("错误", "请填写保存路径")
                 return
             
-            # 历史记录处理（空关键词不保存）
-            if keywords and keywords not in self.keyword_history:
-                self.keyword_history.insert(0, keywords)
-                # 保持历史记录不超过20条
-                if len(self.keyword_history) > 20:
-                    self.keyword_history.pop()
-                self.save_history()
-                self.logcat_history['values'] = self.keyword_history
-                self.kmsg_history['values'] = self.keyword_history
-                self.qsee_log_history['values'] = self.keyword_history
-
-            q = queue.Queue()
-            window_id = str(uuid.uuid4())
-            self.queues[window_id] = q
-            self.create_window(window_id, log_type, path)
-            self.running_flags[window_id] = True  # 新增运行标志
-            threading.Thread(target=self.capture, args=(log_type, keywords, path, case, q, window_id), daemon=True).start()
-            self.after(100, self.update_display, window_id)
-
-    def create_window(self, window_id, log_type, path):
+            self.remember_keywords(keywords)
+            if len(serials) > 1:
+                path = self.device_path(path, serial)
+
+            title = f"{log_type}@{serial}" if serial else log_type
+            opened = self.open_capture(title, path, storage, keywords, case)
+            if opened is None:
+                return
+            if log_type == 'kmsg':
+                # 记录开机时刻，离线合并时用于把内核时间换算为设备时间；adb查询较慢，放到后台线程
+                threading.Thread(target=self.save_device_clock, args=(serial, path), daemon=True).start()
+            window_id, writer, channel = opened
+            session = CaptureSession(window_id, log_type, keywords, case, writer, channel)
+            session.serial = serial
+            session.filter_workers = workers
+            if log_type == 'kmsg':
+                session.kmsg_filter = self.kmsg_options()
+            if self.keep_raw.get():
+                root, ext = os.path.splitext(path)
+                session.raw_path = f"{root}_raw{ext}"
+            self.configure_stages(session, trigger, dedup, monitor, stream)
+            self.run_session(session)
+
+    def configure_stages(self, session, trigger, dedup, monitor, stream=None):
+        """按存储选项给抓取会话装上触发、刷屏抑制、速率异常检测和附加输出端"""
+        if trigger:
+            session.trigger = TriggerStage(**trigger)
+        if self.dedup_file.get():
+            session.file_dedup = DedupStage(**dedup)
+        if self.dedup_view.get():
+            session.view_dedup = DedupStage(**dedup)
+        if monitor:
+            session.monitor = RateMonitor(session.filter.keywords, **monitor)
+        if stream:
+            session.sinks.append(TcpStreamSink(**stream))
+
+    def start_replay(self):
+        """把已保存的日志按指定速度回放进抓取管道，过滤结果另存并显示吞吐"""
+        path = filedialog.askopenfilename(title="选择要回放的日志", initialdir=self.default_dir)
+        if not path:
+            return
+        keywords = simpledialog.askstring("回放日志", "关键词（逗号分隔，不区分大小写）:", parent=self)
+        if keywords is None:
+            return
+        speed = simpledialog.askfloat("回放日志", "回放速度（1为原速，N为N倍速，0为尽快）:",
+                                      initialvalue=1.0, minvalue=0.0, parent=self)
+        if speed is None:
+            return
+        storage = self.storage_options()
+        trigger = self.trigger_options()
+        dedup = self.dedup_options()
+        monitor = self.monitor_options()
+        stream = self.stream_options()
+        if storage is None or trigger is None or dedup is None or monitor is None or stream is None:
+            return
+        keywords = keywords.strip()
+        self.remember_keywords(keywords)
+        root, ext = os.path.splitext(path[:-3] if path.endswith('.gz') else path)
+        output = f"{root}_replay_{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}"
+        title = f"回放 {os.path.basename(path)} " + (f"x{speed:g}" if speed else "最快")
+        opened = self.open_capture(title, output, storage, keywords, False)
+        if opened is None:
+            return
+        window_id, writer, channel = opened
+        session = CaptureSession(window_id, 'replay', keywords, False, writer, channel)
+        self.configure_stages(session, trigger, dedup, monitor, stream)
+        self.run_session(session, ReplaySource(path, speed))
+
+    def start_timeline(self):
+        """把已启用的来源按设备时间合并到同一个窗口中实时显示"""
+        tasks = self.collect_tasks()
+        storage = self.storage_options()
+        if tasks is None or storage is None:
+            return
+        if len(tasks) < 2:
+            messagebox.showerror("错误", "合并时间线至少需要启用两个日志类型")
+            return
+
+        serials = self.selected_serials()
+        if serials is None:
+            return
+
+        for log_type, keywords, path, case in tasks:
+            self.remember_keywords(keywords)
+        
+        inputs = [(log_type, keywords, case) for log_type, keywords, path, case in tasks]
+        for serial in serials:
+            # 每台设备一个时间线窗口，时钟各自换算
+            path = f"{self.default_dir}/timeline.txt"
+            if len(serials) > 1:
+                path = self.device_path(path, serial)
+            opened = self.open_capture(f"时间线@{serial}" if serial else "时间线", path, storage)
+            if opened is None:
+                return
+            window_id, writer, channel = opened
+            # 设备时钟在读取循环的线程池中查询，见attach_timeline
+            self.run_session(LiveTimeline(window_id, inputs, None, writer, channel, serial=serial))
+
+    def merge_saved(self):
+        """离线合并已保存的日志会话（每个会话选择其当前文件），在后台线程中流式归并"""
+        paths = filedialog.askopenfilenames(title="选择要合并的日志", initialdir=self.default_dir)
+        if not paths:
+            return
+        if len(paths) < 2:
+            messagebox.showerror("错误", "请至少选择两个日志文件")
+            return
+        output = os.path.join(self.default_dir, f"timeline_{datetime.now().strftime('%Y%m%d-%H%M%S')}.txt")
+
+        def run_merge():
+            try:
+                start_line = merge_log_files(paths, output)
+                self.after(0, lambda: self.open_file_view(output, start_line))
+            except Exception as e:
+                error_msg = f"合并失败：{str(e)}"
+                self.after(0, lambda: messagebox.showerror("错误", error_msg))
+
+        threading.Thread(target=run_merge, daemon=True).start()
+
+    def refilter_saved(self):
+        """用新关键词重新过滤已保存的原始日志（选择会话的当前原始日志文件）"""
+        raw_path = filedialog.askopenfilename(title="选择原始日志", initialdir=self.default_dir,
+                                              filetypes=[("原始日志", "*_raw*"), ("所有文件", "*.*")])
+        if not raw_path:
+            return
+        keywords = simpledialog.askstring("重新过滤", "关键词（逗号分隔，不区分大小写）:", parent=self)
+        if keywords is None:
+            return
+        keywords = keywords.strip()
+        self.remember_keywords(keywords)
+        root, ext = os.path.splitext(raw_path)
+        output = f"{root}_refilter_{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}"
+
+        def run_refilter():
+            try:
+                start_line = refilter_session(raw_path, keywords, False, output)
+                self.after(0, lambda: self.open_file_view(output, start_line))
+            except Exception as e:
+                error_msg = f"重新过滤失败：{str(e)}"
+                self.after(0, lambda: messagebox.showerror("错误", error_msg))
+
+        threading.Thread(target=run_refilter, daemon=True).start()
+
+    def search_saved(self):
+        """在日志目录下的所有历史日志中并行搜索关键词，结果边搜边显示"""
+        folder = filedialog.askdirectory(title="选择要搜索的日志目录", initialdir=self.default_dir)
+        if not folder:
+            return
+        keywords = simpledialog.askstring("搜索历史日志", "关键词（逗号分隔，不区分大小写）:", parent=self)
+        if not keywords or not keywords.strip():
+            return
+        keywords = keywords.strip()
+        self.remember_keywords(keywords)
+        paths = sorted(path for path in glob.glob(os.path.join(folder, '**', '*'), recursive=True)
+                       if os.path.isfile(path) and not path.endswith(SEARCH_SKIP))
+
+        window = tk.Toplevel(self)
+        window.title(f"搜索 {keywords} - {folder}")
+        window.geometry("900x450")
+        status = ttk.Label(window, text=f"正在搜索 {len(paths)} 个文件……")
+        status.pack(fill='x', padx=5, pady=2)
+        output = scrolledtext.ScrolledText(window, wrap=tk.NONE)
+        output.pack(expand=True, fill='both')
+        locations = []  # 结果的第i行对应的(文件, 行号)
+        results = queue.Queue()
+        cancelled = threading.Event()
+
+        def run_search():
+            started = time.time()
+            total = sum(os.path.getsize(path) for path in paths)
+            count = 0
+            try:
+                for path, line_no, text in search_archives(paths, keywords, False):
+                    if cancelled.is_set():
+                        return
+                    results.put((path, line_no, text))
+                    count += line_no is not None
+                elapsed = max(time.time() - started, 1e-6)
+                results.put((None, None, f"完成：{len(paths)} 个文件 {total / 1024 / 1024:.0f} MB，"
+                                         f"{count} 处匹配，用时 {elapsed:.1f} 秒（{total / 1024 / 1024 / elapsed:.0f} MB/s）"))
+            except Exception as e:
+                results.put((None, None, f"搜索失败：{str(e)}"))
+
+        def poll():
+            if not window.winfo_exists():
+                return
+            chunk = []
+            while len(chunk) < 2000:
+                try:
+                    path, line_no, text = results.get_nowait()
+                except queue.Empty:
+                    break
+                if path is None:
+                    status.config(text=text)
+                    continue
+                locations.append((path, line_no))
+                location = f"{os.path.relpath(path, folder)}:{line_no}" if line_no else os.path.relpath(path, folder)
+                chunk.append(f"{location}: {text}\n")
+            if chunk:
+                output.insert(tk.END, ''.join(chunk))
+            window.after(100, poll)
+
+        def jump(event):
+            row = int(output.index(f"@{event.x},{event.y}").split('.')[0]) - 1
+            if 0 <= row < len(locations) and locations[row][1]:
+                self.open_search_result(*locations[row])
+
+        def on_close():
+            cancelled.set()
+            window.destroy()
+
+        output.bind('<Double-Button-1>', jump)
+        window.protocol("WM_DELETE_WINDOW", on_close)
+        threading.Thread(target=run_search, daemon=True).start()
+        poll()
+
+    def build_saved_index(self):
+        """为已保存的会话（选择其当前文件）在后台建立全文索引"""
+        path = filedialog.askopenfilename(title="选择要建立索引的日志", initialdir=self.default_dir)
+        if not path:
+            return
+
+        def run_build():
+            try:
+                started = time.time()
+                count = FtsIndex.build(path)
+                message = f"已为 {count} 行建立全文索引，用时 {time.time() - started:.1f} 秒"
+                self.after(0, lambda: messagebox.showinfo("完成", message))
+            except Exception as e:
+                error_msg = f"建立索引失败：{str(e)}"
+                self.after(0, lambda: messagebox.showerror("错误", error_msg))
+
+        threading.Thread(target=run_build, daemon=True).start()
+
+    def query_saved_index(self):
+        """按关键词、时间范围、级别和标签查询会话的全文索引"""
+        path = filedialog.askopenfilename(title="选择已建立索引的日志", initialdir=self.default_dir,
+                                          filetypes=[("日志", "*.txt *.log"), ("所有文件", "*.*")])
+        if not path:
+            return
+        window = tk.Toplevel(self)
+        window.title(f"全文索引查询 - {os.path.basename(path)}")
+        window.geometry("900x450")
+        form = ttk.Frame(window)
+        form.pack(fill='x', padx=5, pady=5)
+        fields = {}
+        for col, (name, label, width) in enumerate([('keywords', "关键词", 20), ('start', "起始时间", 19),
+                                                    ('end', "结束时间", 19), ('levels', "级别(如EW)", 5),
+                                                    ('tag', "标签", 12)]):
+            ttk.Label(form, text=label).grid(row=0, column=col * 2, padx=(5, 2))
+            fields[name] = ttk.Entry(form, width=width)
+            fields[name].grid(row=0, column=col * 2 + 1)
+        status = ttk.Label(window, text="时间格式: YYYY-mm-dd HH:MM:SS（设备本地时间），可留空")
+        status.pack(fill='x', padx=5)
+        output = scrolledtext.ScrolledText(window, wrap=tk.NONE)
+        output.pack(expand=True, fill='both')
+        rows = []
+
+        def parse_time(text):
+            text = text.strip()
+            if not text:
+                return None
+            return calendar.timegm(datetime.strptime(text, "%Y-%m-%d %H:%M:%S").timetuple())
+
+        def run_query():
+            try:
+                start = parse_time(fields['start'].get())
+                end = parse_time(fields['end'].get())
+                started = time.time()
+                rows[:] = FtsIndex.query(path, fields['keywords'].get(), start, end,
+                                         fields['levels'].get().strip().upper(), fields['tag'].get().strip())
+            except ValueError:
+                messagebox.showerror("错误", "时间格式应为 YYYY-mm-dd HH:MM:SS")
+                return
+            except (OSError, sqlite3.Error) as e:
+                messagebox.showerror("错误", f"查询失败：{str(e)}")
+                return
+            output.delete('1.0', tk.END)
+            output.insert('1.0', ''.join(f"{line + 1}: {text}\n" for line, ts, level, tag, text in rows))
+            status.config(text=f"{len(rows)} 条结果，用时 {(time.time() - started) * 1000:.0f} ms" +
+                          ("（最多显示1000条）" if len(rows) >= 1000 else ""))
+
+        def jump(event):
+            row = int(output.index(f"@{event.x},{event.y}").split('.')[0]) - 1
+            if 0 <= row < len(rows):
+                self.open_file_view(path, rows[row][0])
+
+        ttk.Button(form, text="查询", command=run_query).grid(row=0, column=10, padx=5)
+        output.bind('<Double-Button-1>', jump)
+
+    def add_find_bar(self, window, view):
+        """给日志窗口加查找栏：输入时增量查找，回车/↓查找下一个，Shift+回车/↑查找上一个，Esc取消"""
+        find_frame = ttk.Frame(window)
+        find_frame.pack(fill="x", padx=5, pady=2, before=view)
+        ttk.Label(find_frame, text="查找:").pack(side="left")
+        find_entry = ttk.Entry(find_frame, width=30)
+        find_entry.pack(side="left", padx=5)
+        case_var = tk.BooleanVar(value=False)
+        status = ttk.Label(find_frame, text="")
+        pending = [None]
+
+        def on_progress(pos):
+            status.config(text=f"查找中… 第 {pos + 1} 行")
+
+        def on_done(pos):
+            status.config(text="" if not find_entry.get() else
+                          (f"第 {pos + 1} 行" if pos is not None else "未找到"))
+
+        def run(forward=True, restart=False):
+            pending[0] = None
+            view.find(find_entry.get(), forward, case_var.get(), restart, on_progress, on_done)
+
+        def on_key(event):
+            if event.keysym in ('Return', 'Escape', 'Up', 'Down', 'Shift_L', 'Shift_R'):
+                return
+            # 停止输入200ms后再从当前位置重新查找
+            if pending[0] is not None:
+                window.after_cancel(pending[0])
+            view.cancel_find()
+            pending[0] = window.after(200, lambda: run(True, True))
+
+        def on_escape(event=None):
+            view.cancel_find(clear=True)
+            status.config(text="")
+
+        ttk.Button(find_frame, text="↑", width=3, command=lambda: run(False)).pack(side="left")
+        ttk.Button(find_frame, text="↓", width=3, command=lambda: run(True)).pack(side="left", padx=(2, 5))
+        ttk.Checkbutton(find_frame, text="区分大小写", variable=case_var).pack(side="left")
+        status.pack(side="left", padx=5)
+        find_entry.bind('<KeyRelease>', on_key)
+        find_entry.bind('<Return>', lambda e: run(True))
+        find_entry.bind('<Shift-Return>', lambda e: run(False))
+        find_entry.bind('<Down>', lambda e: run(True))
+        find_entry.bind('<Up>', lambda e: run(False))
+        find_entry.bind('<Escape>', on_escape)
+        window.bind('<Control-f>', lambda e: find_entry.focus_set())
+
+    def open_search_result(self, path, line_no):
+        """打开搜索结果所在的日志；有索引的会话文件换算为会话内的全局行号"""
+        index = SegmentIndex(path)
+        for seg in index.segments:
+            if os.path.abspath(seg['path']) == os.path.abspath(path) and seg['lines']:
+                self.open_file_view(path, seg['first_line'] + line_no - 1)
+                return
+        self.open_file_view(path, line_no - 1)
+
+    def open_file_view(self, path, line=0):
+        """用虚拟化视图打开已保存的日志，内容全部按需从磁盘读取
+
+        抓取产生的会话用其.idx分段索引；其他文件mmap后在后台建立稀疏行索引，打开不必等索引完成。
+        """
+        index = SegmentIndex(path)
+        if not any(seg['lines'] for seg in index.segments):
+            try:
+                index = FileLineIndex(path)
+            except (OSError, ValueError) as e:
+                messagebox.showerror("错误", f"无法打开日志：{str(e)}")
+                return
+        window = tk.Toplevel(self)
+        window.title(f"日志查看 - {os.path.basename(path)}")
+        window.geometry("800x400")
+
+        jump_frame = ttk.Frame(window)
+        jump_frame.pack(fill='x', padx=5, pady=2)
+        view = LogView(window, path=path, start_line=index.total_lines())
+        view.index = index
+        view.history_enabled.set(True)
+        view.follow = False
+        view.top = line
+        view.pack(expand=True, fill='both')
+        self.add_find_bar(window, view)
+        target = [line]  # 目标行尚未索引到时，等索引到了再跳
+
+        def goto(line_no):
+            target[:] = [line_no] if line_no >= view.start_line else []
+            view.scroll_to(line_no)
+
+        ttk.Label(jump_frame, text="行号:").pack(side="left")
+        line_entry = ttk.Entry(jump_frame, width=10)
+        line_entry.pack(side="left", padx=(2, 5))
+        ttk.Label(jump_frame, text="设备时间(YYYY-mm-dd HH:MM:SS):").pack(side="left")
+        time_entry = ttk.Entry(jump_frame, width=20)
+        time_entry.pack(side="left", padx=2)
+        status = ttk.Label(jump_frame, text="")
+        status.pack(side="right")
+
+        def jump_line(event=None):
+            try:
+                goto(int(line_entry.get()) - 1)
+            except ValueError:
+                messagebox.showerror("错误", "行号必须是整数", parent=window)
+
+        def jump_time(event=None):
+            try:
+                when = datetime.strptime(time_entry.get().strip(), "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                messagebox.showerror("错误", "时间格式应为 YYYY-mm-dd HH:MM:SS", parent=window)
+                return
+            goto(index.line_at_time(when))
+
+        line_entry.bind('<Return>', jump_line)
+        time_entry.bind('<Return>', jump_time)
+        ttk.Button(jump_frame, text="跳转", command=jump_line).pack(side="left", after=line_entry)
+        ttk.Button(jump_frame, text="跳转", command=jump_time).pack(side="left", after=time_entry)
+
+        def refresh():
+            # 后台索引进行中时定期更新总行数和滚动条
+            if not window.winfo_exists():
+                return
+            view.start_line = index.total_lines()
+            if target and (target[0] < view.start_line or getattr(index, 'done', True)):
+                view.scroll_to(target.pop())
+            else:
+                view.scroll_to(view.top)
+            if isinstance(index, FileLineIndex) and not index.done:
+                status.config(text=f"正在建立行索引 {index.progress() * 100:.0f}%  已索引 {view.start_line} 行")
+                window.after(200, refresh)
+            else:
+                status.config(text=f"共 {view.start_line} 行")
+
+        def on_close():
+            if isinstance(index, FileLineIndex):
+                index.close()
+            window.destroy()
+
+        window.protocol("WM_DELETE_WINDOW", on_close)
+        window.after(200, refresh)
+
+    def create_window(self, window_id, log_type, path, start_line=0, keywords=None, case=False):
         window = tk.Toplevel(self)
         window.title(f"{log_type}日志 - {os.path.basename(path)}")
         window.geometry("800x400")
         
-        text_area = scrolledtext.ScrolledText(window, wrap=tk.WORD)
-        text_area.pack(expand=True, fill='both')
+        if keywords is not None:
+            # 关键词栏：运行中切换过滤条件，不中断抓取
+            filter_frame = ttk.Frame(window)
+            filter_frame.pack(fill="x", padx=5, pady=2)
+            ttk.Label(filter_frame, text="关键词:").pack(side="left")
+            keyword_entry = ttk.Entry(filter_frame)
+            keyword_entry.insert(0, keywords)
+            keyword_entry.pack(side="left", fill="x", expand=True, padx=5)
+            case_var = tk.BooleanVar(value=case)
+            replay_var = tk.BooleanVar(value=True)
+            ttk.Checkbutton(filter_frame, text="区分大小写", variable=case_var).pack(side="left")
+            ttk.Checkbutton(filter_frame, text="回放最近日志", variable=replay_var).pack(side="left", padx=5)
+            apply_filter = lambda e=None: self.change_filter(
+                window_id, keyword_entry.get().strip(), case_var.get(), replay_var.get())
+            ttk.Button(filter_frame, text="应用", command=apply_filter).pack(side="left")
+            keyword_entry.bind('<Return>', apply_filter)
+        
+        # 虚拟化视图：内存和重绘开销固定，不随抓取时长增长
+        view = LogView(window, path=path, start_line=start_line)
+        view.pack(expand=True, fill='both')
+        self.add_find_bar(window, view)
         
-        ttk.Button(window, text="打开文件", command=lambda: os.startfile(path)).pack(pady=5)
+        btn_frame = ttk.Frame(window)
+        btn_frame.pack(pady=5)
+        ttk.Button(btn_frame, text="打开文件", command=lambda: self.open_file_view(path)).pack(side="left", padx=5)
+        ttk.Checkbutton(btn_frame, text="翻阅磁盘历史", variable=view.history_enabled,
+                        command=lambda: view.scroll_to(view.top)).pack(side="left", padx=5)
+        ttk.Button(btn_frame, text="导出统计", command=lambda: self.export_stats(window_id)).pack(side="left", padx=5)
+        
+        # 统计条：每秒刷新一次各阶段计数
+        stats_label = ttk.Label(window, text="", anchor="w")
+        stats_label.pack(fill="x", padx=5, before=view)
         
         self.log_windows[window_id] = {
             'window': window,
-            'text_area': text_area,
-            'file': open(path, 'a', encoding='utf-8')
+            'view': view,
+            'stats_label': stats_label,
+            'stats_time': 0
         }
         window.protocol("WM_DELETE_WINDOW", lambda: self.close_window(window_id))
 
+    def change_filter(self, window_id, keywords, case, replay):
+        session = self.sessions.get(window_id)
+        if session is None:
+            return
+        self.remember_keywords(keywords)
+        self.capture_loop.call(session.swap_filter, LineFilter(keywords, case), replay)
+
+    def export_stats(self, window_id):
+        session = self.sessions.get(window_id)
+        if session is None:
+            return
+        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV", "*.csv")])
+        if path:
+            try:
+                session.stats.export(path)
+            except OSError as e:
+                messagebox.showerror("错误", f"导出统计失败：{str(e)}")
+
     def close_window(self, window_id):
         """安全关闭窗口的流程"""
         if window_id in self.running_flags:
             self.running_flags[window_id] = False  # 停止捕获线程
             
-        if window_id in self.processes:
-            self.processes[window_id].terminate()  # 终止ADB进程
-            del self.processes[window_id]
+        if window_id in self.sessions:
+            # 卸载订阅者；最后一个订阅者离开时上游ADB进程才会终止
+            self.capture_loop.call(self.detach, self.sessions.pop(window_id))
             
         if window_id in self.log_windows:
-            self.log_windows[window_id]['file'].close()  # 关闭文件
+            # 文件由写盘线程在收到结束通知后关闭，避免与最后一次写入竞争
             self.log_windows[window_id]['window'].destroy()
             del self.log_windows[window_id]
+        self.channels.pop(window_id, None)
 
-    def capture(self, log_type, keywords, path, case_sensitive, q, window_id):
-        keywords = [k.strip() for k in keywords.split(',')]
-        cmd = ['adb', 'shell', 'logcat'] if log_type == 'logcat' else (
-    ['adb', 'shell', 'cat', '/proc/kmsg'] if log_type == 'kmsg' 
-    else ['adb', 'shell', 'cat', '/proc/tzdbg/qsee_log']
-)
-        
+    def attach(self, session, replay=None):
+        """在读取循环中把订阅者挂到共享的上游进程上；回放时挂到指定的回放源"""
+        if isinstance(session, LiveTimeline) and session.clock is None:
+            self.capture_loop.loop.create_task(self.attach_timeline(session))
+            return
+        if getattr(session, 'sinks', None):  # 时间线没有附加输出端
+            self.capture_loop.loop.create_task(session.open_sinks())
+        if replay is not None:
+            for sub in session.subscriptions():
+                replay.subscribe(sub)
+            self.capture_loop.loop.create_task(replay.run())
+            return
+        for sub in session.subscriptions():
+            key = (sub.serial, sub.log_type)
+            source = self.sources.get(key)
+            if source is None or source.stopping:
+                workers = getattr(session, 'filter_workers', 0)
+                source_class = KmsgSource if sub.log_type == 'kmsg' else LogSource
+                source = source_class(sub.log_type, serial=sub.serial, on_exit=self.remove_source,
+                                      pool=self.get_filter_pool(workers) if workers else None,
+                                      on_pool_broken=self.discard_filter_pool)
+                self.sources[key] = source
+                source.subscribe(sub)
+                self.capture_loop.loop.create_task(source.run())
+            else:
+                source.subscribe(sub)
+
+    def get_filter_pool(self, workers):
+        """多进程过滤共用的进程池，按需创建；进程数与当前的不同时新建，旧的等用它的上游都结束后关闭"""
+        if self.filter_pool is None or self.filter_workers != workers:
+            old = self.filter_pool
+            self.filter_pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+            self.filter_workers = workers
+            self.release_filter_pool(old)
+        return self.filter_pool
+
+    def discard_filter_pool(self, pool):
+        """上游提交时发现进程池已损坏（有进程异常退出）：下一次抓取换一个新的"""
+        if pool is self.filter_pool:
+            self.filter_pool = None
+        self.release_filter_pool(pool)
+
+    def release_filter_pool(self, pool):
+        """关闭不再是当前进程池、也没有上游在用的进程池"""
+        if pool is not None and pool is not self.filter_pool and \
+                not any(source.pool is pool for source in self.sources.values()):
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def save_device_clock(serial, path):
         try:
-            proc = subprocess.Popen(cmd, 
-                                   stdout=subprocess.PIPE,
-                                   text=True,
-                                   encoding='utf-8',
-                                   errors='replace')
-            self.processes[window_id] = proc
-            
-            # 新增批量处理机制
-            buffer = []
-            last_flush = time.time()
-            
-            while self.running_flags.get(window_id, False):
-                line = proc.stdout.readline()
-                if not line:
-                    time.sleep(0.1)  # 防止CPU空转
-                    continue
-                
-                if self.check_filter(line, keywords, case_sensitive):
-                    buffer.append(line)
-                    q.put(line)  # 先存入队列
-                    
-                    # 批量写入文件（每100条或0.5秒刷新一次）
-                    if len(buffer) >= 100 or (time.time() - last_flush) > 0.5:
-                        self.log_windows[window_id]['file'].writelines(buffer)
-                        buffer.clear()
-                        last_flush = time.time()
-                        
-                # 检查进程状态
-                if proc.poll() is not None:
-                    break
-                
-            # 写入剩余缓存
-            if buffer:
-                self.log_windows[window_id]['file'].writelines(buffer)
-                
-        except Exception as e:
-            q.put(f"Error: {str(e)}")
-        finally:
-            self.close_window(window_id)
+            DeviceClock.query(serial).save(path)
+        except OSError:
+            pass
 
-    def check_filter(self, line, keywords, case_sensitive):
-        if not keywords:
-            return True
-        line_check = line if case_sensitive else line.lower()
-        return any(
-            (kw if case_sensitive else kw.lower()) in line_check 
-            for kw in keywords
-        )
+    async def attach_timeline(self, timeline):
+        """读取设备时钟（adb调用可能耗时数秒）后再把时间线挂到上游"""
+        timeline.clock = await asyncio.get_running_loop().run_in_executor(None, DeviceClock.query, timeline.serial)
+        if not timeline.closed:
+            self.attach(timeline)
+
+    def detach(self, session):
+        if isinstance(session, LiveTimeline) and session.clock is None:
+            session.close()  # 还在读取设备时钟，尚未挂到上游
+            return
+        for sub in session.subscriptions():
+            if sub.source is not None:
+                sub.source.unsubscribe(sub.window_id)
+
+    def remove_source(self, source):
+        if self.sources.get(source.key) is source:
+            del self.sources[source.key]
+        self.release_filter_pool(source.pool)
 
     def update_display(self, window_id):
         if window_id not in self.running_flags or not self.running_flags[window_id]:
             return
         
+        channel = self.channels[window_id]
+        delay = 50
         try:
-            # 批量更新界面（每次最多处理50行）
-            max_lines = 50
-            processed = 0
+            # 按积压量自适应：积压越多每周期取得越多、间隔越短
+            max_lines = max(500, channel.pending // 2)
+            numbers, lines, spans, finished = channel.drain(max_lines)
             
-            while not self.queues[window_id].empty() and processed < max_lines:
-                line = self.queues[window_id].get_nowait()
-                self.log_windows[window_id]['text_area'].insert(tk.END, line)
-                processed += 1
-                
-            self.log_windows[window_id]['text_area'].see(tk.END)
+            # 每个周期只重绘一次可见区域，关键词高亮也在这一次重绘中批量完成
+            window = self.log_windows[window_id]
+            window['view'].append(numbers, lines, spans)
             
-        except queue.Empty:
-            pass
+            session = self.sessions.get(window_id)
+            if session is not None and time.time() - window['stats_time'] >= 1.0:
+                window['stats_time'] = time.time()
+                row = session.stats.snapshot(channel, session.writer)
+                window['stats_label'].config(text=CaptureStats.format(row))
+                if isinstance(session, CaptureSession):
+                    self.capture_loop.call(session.tick, time.time())
+            
+            if finished:
+                # 抓取已结束，在界面线程中关闭窗口
+                self.close_window(window_id)
+                return
+            if channel.pending:
+                delay = 10
         finally:
-            self.after(50, self.update_display, window_id)
+            self.after(delay, self.update_display, window_id)
 
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # 打包为exe后进程池子进程需要
     app = MainApplication()
     # 配置样式
     style = ttk.Style()